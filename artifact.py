@@ -0,0 +1,148 @@
+""" Local snapshot of the reference data (shapes, simplified shape layers, centroids, counties and years)
+so workers start without the databases.
+
+Each snapshot is written to its own folder (versioned_dir) and the CURRENT file points to the latest one, so workers
+never read a half written snapshot; One process builds it while the others wait and load it. Build it ahead of a deploy with:
+    python artifact.py build
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+
+import data_collection as dc
+import versioned_dir
+
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 3
+ARTIFACT_DIR = dc.config.get('artifact', 'Path', fallback=os.path.join(dc.DATA_DIR, 'reference'))
+CHECK_SOURCE = dc.config.getboolean('artifact', 'CheckSource', fallback=True)
+
+# Cheap single row queries that change whenever the source tables change
+FINGERPRINT_QUERIES = {
+    'shapes': dc.CHANGE_MARKER_QUERIES['shapes'],
+    'drought': [
+        'SELECT COUNT(*), MIN(year), MAX(year) FROM dbo.spei',
+    ],
+}
+
+
+def source_fingerprint():
+    """ Hash of the change markers of the source tables; Returns None if the databases can't be queried """
+    pools = {'shapes': dc.SHAPES_POOL, 'drought': dc.DATA_POOL}
+    markers = []
+    try:
+        for name, queries in FINGERPRINT_QUERIES.items():
+            with pools[name].connection() as conn:
+                cursor = conn.cursor()
+                for query in queries:
+                    cursor.execute(query)
+                    markers.append([str(value) for value in cursor.fetchone()])
+                cursor.close()
+    except Exception:
+        logger.warning('Could not read the source fingerprint', exc_info=True)
+        return None
+    return hashlib.sha1(json.dumps([ARTIFACT_VERSION, markers]).encode('utf-8')).hexdigest()[:16]
+
+
+def _read_json(file_name: str):
+    with open(file_name, 'rb') as f:
+        return json.loads(f.read())
+
+
+def save_artifact(shapes: dict, centroids: dict, counties: dict, years: list, shape_layers: dict,
+                  fingerprint=None, path: str = ARTIFACT_DIR) -> str:
+    """ Write a new snapshot and make it the current one; Returns the snapshot folder """
+    tmp_dir = versioned_dir.new_version(path, fingerprint or 'unversioned')
+    for type_name, geojson in shapes.items():
+        with open(os.path.join(tmp_dir, f'shapes_{type_name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(geojson, f, ensure_ascii=False)
+    for level, layers in shape_layers.items():
+        for type_name, geojson in layers.items():
+            with open(os.path.join(tmp_dir, f'layer_{level}_{type_name}.json'), 'w', encoding='utf-8') as f:
+                json.dump(geojson, f, ensure_ascii=False)
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'fingerprint': fingerprint,
+        'shape_types': list(shapes),
+        'layer_levels': list(shape_layers),
+        'centroids': {type_name: df.to_dict(orient='list') for type_name, df in centroids.items()},
+        'counties': counties,
+        'years': [int(year) for year in years],
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    target = versioned_dir.publish(path, tmp_dir)
+    logger.info(f'Reference data snapshot written to {target}')
+    return target
+
+
+def load_artifact(fingerprint=None, path: str = ARTIFACT_DIR):
+    """ Read the current snapshot; Returns (shapes, centroids, counties, years, shape_layers) or None if missing or stale.
+    The snapshot is stale if a fingerprint is given and it doesn't match the one it was built from.
+    """
+    return versioned_dir.read_current(path, lambda folder: _load_folder(folder, fingerprint))
+
+
+def _load_folder(folder: str, fingerprint=None):
+    manifest = _read_json(os.path.join(folder, 'manifest.json'))
+    if manifest.get('version') != ARTIFACT_VERSION:
+        return None
+    if fingerprint is not None and manifest.get('fingerprint') != fingerprint:
+        logger.info('Reference data snapshot is stale')
+        return None
+    shapes = {type_name: _read_json(os.path.join(folder, f'shapes_{type_name}.json')) for type_name in manifest['shape_types']}
+    shape_layers = {level: {type_name: _read_json(os.path.join(folder, f'layer_{level}_{type_name}.json'))
+                            for type_name in manifest['shape_types']}
+                    for level in manifest['layer_levels']}
+    centroids = {type_name: pd.DataFrame(columns) for type_name, columns in manifest['centroids'].items()}
+    return shapes, centroids, manifest['counties'], manifest['years'], shape_layers
+
+
+def build_artifact(path: str = ARTIFACT_DIR, fingerprint=None):
+    """ Load the reference data from the databases and snapshot it; Returns (shapes, centroids, counties, years, shape_layers).
+    Holds the build lock of the snapshot folder: a process finding that another one built the snapshot of the same
+    fingerprint while it waited loads that snapshot instead.
+    """
+    if fingerprint is None:
+        fingerprint = source_fingerprint()
+    with versioned_dir.build_lock(path):
+        if fingerprint is not None:
+            data = load_artifact(fingerprint, path)
+            if data is not None:
+                logger.info('Reference data snapshot already built by another process')
+                return data
+        shapes, centroids, counties, years, timings = dc.load_startup_data()
+        shape_layers = dc.simplify_shape_levels(shapes)
+        save_artifact(shapes, centroids, counties, years, shape_layers, fingerprint, path)
+    return shapes, centroids, counties, years, shape_layers
+
+
+def load_reference_data(path: str = ARTIFACT_DIR, check_source: bool = CHECK_SOURCE):
+    """ Return (shapes, centroids, counties, years, shape_layers) from the local snapshot, rebuilding it from the databases
+    if it is missing or the source tables changed since it was built (checked only when check_source is True).
+    """
+    fingerprint = source_fingerprint() if check_source else None
+    data = load_artifact(fingerprint, path)
+    if data is None:
+        logger.info('Building the reference data snapshot from the databases')
+        data = build_artifact(path, fingerprint)
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Snapshot the reference data to a local folder')
+    parser.add_argument('command', choices=['build', 'check'])
+    parser.add_argument('--path', default=ARTIFACT_DIR)
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_artifact(args.path)
+    else:
+        fresh = load_artifact(source_fingerprint(), args.path) is not None
+        print('up to date' if fresh else 'stale or missing')
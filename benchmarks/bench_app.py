@@ -0,0 +1,10 @@
+""" The dashboard's Flask server on the SQLite stand-in, for gunicorn workers started by load_test.py:
+BENCH_DB=/tmp/drought_bench/drought.db gunicorn -w 4 bench_app:server (from the workdir, with benchmarks/ on PYTHONPATH)
+"""
+import os
+
+import fake_db
+
+fake_db.install(os.environ['BENCH_DB'])
+
+from drought_heatmap import server  # noqa: E402,F401
@@ -0,0 +1,78 @@
+""" Compare pd.read_sql_query against the columnar fetch_arrays path on a local SQLite copy of dbo.spei.
+
+python benchmarks/bench_fetch.py --points 60000 --years 5
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_collection as dc  # noqa: E402
+from db_pool import ConnectionPool  # noqa: E402
+from queries import fetch_arrays  # noqa: E402
+
+
+def make_database(path: str, n_points: int, n_years: int):
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(44, 63, n_points), rng.uniform(25, 40, n_points)
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE spei (x REAL, y REAL, year INTEGER, value REAL)')
+        for year in range(2000, 2000 + n_years):
+            conn.executemany('INSERT INTO spei VALUES (?, ?, ?, ?)',
+                             zip(x.tolist(), y.tolist(), [year] * n_points, rng.normal(0, 1, n_points).tolist()))
+        conn.execute('CREATE INDEX ix_spei_year ON spei (year)')
+
+
+def timed(func, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=60000)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'spei.db')
+        make_database(path, args.points, args.years)
+
+        def connect():
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.execute(f"ATTACH DATABASE '{path}' AS dbo")
+            return conn
+
+        pool = ConnectionPool(connect, name='bench')
+        years = list(range(2000, 2000 + args.years))
+        placeholders = ', '.join('?' * len(years))
+        sql = f'SELECT x, y, year, value FROM dbo.spei WHERE year IN ({placeholders})'
+
+        def read_sql():
+            with pool.connection() as conn:
+                return pd.read_sql_query(sql, conn, params=years)
+
+        old_time, old = timed(read_sql, args.repeat)
+        new_time, new = timed(lambda: fetch_arrays(pool, 'bench', dc.SPEI_DTYPES, tuple(years), sql=sql), args.repeat)
+        new_bytes = sum(array.nbytes for array in new.values())
+
+        print(f'{args.years} years x {args.points} points in one query')
+        print(f'pd.read_sql_query: {old_time:8.3f} s  {old.memory_usage(index=False).sum():>12,} bytes')
+        print(f'fetch_arrays:      {new_time:8.3f} s  {new_bytes:>12,} bytes  ({old_time / new_time:.1f}x)')
+        same = all(np.allclose(old[column].to_numpy(), new[column], atol=1e-4) for column in ('x', 'y', 'year', 'value'))
+        print(f'same values (float32 precision): {same}')
+
+
+if __name__ == '__main__':
+    main()
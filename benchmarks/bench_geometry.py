@@ -0,0 +1,71 @@
+""" Compare make_polygon row by row against the vectorized decode_geometries on a synthetic shapes table.
+
+python benchmarks/bench_geometry.py --rows 430 --vertices 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_collection as dc  # noqa: E402
+
+
+def ring_string(rng, n_vertices: int) -> str:
+    """ A closed ring around a random center in the string format of the shapes database """
+    cx, cy = rng.uniform(44, 63), rng.uniform(25, 40)
+    angles = np.linspace(0, 2 * np.pi, n_vertices)
+    radius = rng.uniform(0.1, 1.0) * (1 + 0.1 * rng.standard_normal(n_vertices))
+    xs, ys = cx + radius * np.cos(angles), cy + radius * np.sin(angles)
+    xs[-1], ys[-1] = xs[0], ys[0]
+    return ', '.join(f'{x} {y}' for x, y in zip(xs, ys))
+
+
+def make_table(n_rows: int, n_vertices: int, multi_share: float = 0.2, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(n_rows):
+        if rng.random() < multi_share:
+            n_parts = rng.integers(2, 5)
+            coords = '|'.join(ring_string(rng, n_vertices // n_parts) for _ in range(n_parts))
+            rows.append(('MultiPolygon', coords))
+        else:
+            rows.append(('Polygon', ring_string(rng, n_vertices)))
+    return pd.DataFrame(rows, columns=['polygon_type', 'coordinates'])
+
+
+def timed(func, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=430)
+    parser.add_argument('--vertices', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_table(args.rows, args.vertices)
+    old_time, old = timed(lambda: df.apply(lambda x: dc.make_polygon(x.coordinates, x.polygon_type), axis=1), args.repeat)
+    new_time, new = timed(lambda: dc.decode_geometries(df['coordinates'], df['polygon_type']), args.repeat)
+
+    same = all(a.equals_exact(b, 0) and a.geom_type == b.geom_type for a, b in zip(old, new))
+    same_json = json.loads(gpd.GeoSeries(list(old)).to_json()) == json.loads(gpd.GeoSeries(list(new)).to_json())
+    print(f'rows: {args.rows}, vertices per row: {args.vertices}')
+    print(f'make_polygon (apply):  {old_time:8.3f} s')
+    print(f'decode_geometries:     {new_time:8.3f} s  ({old_time / new_time:.1f}x)')
+    print(f'identical geometries: {same}, identical GeoJSON: {same_json}')
+
+
+if __name__ == '__main__':
+    main()
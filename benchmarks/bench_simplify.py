@@ -0,0 +1,50 @@
+""" Payload size and serialization time of the shape layers at full resolution and at each simplification level.
+
+python benchmarks/bench_simplify.py --rows 430 --vertices 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import geopandas as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_collection as dc  # noqa: E402
+from bench_geometry import make_table  # noqa: E402
+
+
+def serialize(geojson: dict, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = json.dumps(geojson)
+        best = min(best, time.perf_counter() - start)
+    return len(payload.encode('utf-8')), best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=430)
+    parser.add_argument('--vertices', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_table(args.rows, args.vertices)
+    geojson = json.loads(gpd.GeoSeries(dc.decode_geometries(df['coordinates'], df['polygon_type'])).to_json())
+
+    start = time.perf_counter()
+    levels = dc.simplify_shape_levels({'shapes': geojson})
+    print(f'simplification of all levels: {time.perf_counter() - start:.3f} s')
+
+    full_size, full_time = serialize(geojson, args.repeat)
+    print(f'{"level":<12}{"bytes":>14}{"ratio":>8}{"json.dumps (s)":>16}')
+    print(f'{"full":<12}{full_size:>14,}{1:>8.1f}{full_time:>16.4f}')
+    for level, layers in levels.items():
+        size, seconds = serialize(layers['shapes'], args.repeat)
+        print(f'{level:<12}{size:>14,}{full_size / size:>8.1f}{seconds:>16.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+""" Checks of the thread and process sensitive primitives: the connection pool, the query executor, the versioned
+folders shared by the workers and the leader election of the refresher. Runs without the databases (SQLite in memory)
+and exits with status 1 if a check fails.
+
+python benchmarks/check_concurrency.py --processes 5 --cycles 15
+"""
+import argparse
+import contextvars
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import versioned_dir  # noqa: E402
+from db_pool import ConnectionPool, PoolTimeout  # noqa: E402
+from query_executor import QueryExecutor, QueryTimeout, Superseded  # noqa: E402
+from refresher import Refresher, Watch  # noqa: E402
+
+
+def memory_pool(**settings) -> ConnectionPool:
+    return ConnectionPool(lambda: sqlite3.connect(':memory:', check_same_thread=False), name='check', **settings)
+
+
+def run_threads(target, n: int) -> list:
+    """ Run target(i) in n threads started together; Returns the exceptions raised """
+    errors = []
+    barrier = threading.Barrier(n)
+
+    def worker(i):
+        barrier.wait()
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def check_pool_bounds():
+    """ Concurrent checkouts never open more than max_size connections, and every one of them is served """
+    pool = memory_pool(max_size=2, checkout_timeout=10)
+    in_use, peak, lock = [0], [0], threading.Lock()
+
+    def work(_):
+        for _ in range(5):
+            with pool.connection() as conn:
+                with lock:
+                    in_use[0] += 1
+                    peak[0] = max(peak[0], in_use[0])
+                conn.execute('SELECT 1')
+                time.sleep(0.005)
+                with lock:
+                    in_use[0] -= 1
+    errors = run_threads(work, 8)
+    stats = pool.stats()
+    assert not errors, errors
+    assert peak[0] <= 2 and stats['open'] <= 2, (peak[0], stats)
+    assert stats['checkouts'] == 40, stats
+
+
+def check_pool_timeout():
+    """ A checkout waiting on a full pool raises PoolTimeout after checkout_timeout """
+    pool = memory_pool(max_size=1, checkout_timeout=0.1)
+    with pool.connection():
+        start = time.monotonic()
+        errors = run_threads(lambda _: pool.connection().__enter__(), 1)
+        waited = time.monotonic() - start
+    assert len(errors) == 1 and isinstance(errors[0], PoolTimeout), errors
+    assert 0.1 <= waited < 2, waited
+    assert pool.stats()['timeouts'] == 1
+
+
+def check_pool_recycle():
+    """ Connections past max_lifetime are closed and replaced, and the ones of a failed block are discarded """
+    pool = memory_pool(max_size=1, max_lifetime=0.05)
+    with pool.connection() as first:
+        pass
+    time.sleep(0.1)
+    with pool.connection() as second:
+        pass
+    assert second is not first and pool.stats()['recycled'] == 1, pool.stats()
+    try:
+        with pool.connection():
+            raise RuntimeError('query failed')
+    except RuntimeError:
+        pass
+    stats = pool.stats()
+    assert stats['open'] == 0 and stats['idle'] == 0, stats
+    with pool.connection() as third:
+        assert third is not second
+
+
+def check_executor_coalescing():
+    """ Identical calls in flight run once and share the result """
+    executor = QueryExecutor(max_workers=4, timeout=5)
+    calls = []
+
+    def query():
+        calls.append(1)
+        time.sleep(0.2)
+        return object()
+    results = []
+    errors = run_threads(lambda _: results.append(executor.run('same', query)), 6)
+    assert not errors, errors
+    assert len(calls) == 1 and len({id(result) for result in results}) == 1, (len(calls), len(results))
+    assert executor.stats()['coalesced'] == 5, executor.stats()
+
+
+def check_executor_supersede():
+    """ A newer call of the same channel makes the older waiting call raise Superseded """
+    executor = QueryExecutor(max_workers=2, timeout=5)
+    started = threading.Event()
+    outcome = []
+
+    def older():
+        with executor.channel('page'):
+            started.set()
+            try:
+                executor.run('slow', time.sleep, 1)
+                outcome.append('finished')
+            except Superseded:
+                outcome.append('superseded')
+    thread = threading.Thread(target=older)
+    thread.start()
+    started.wait()
+    time.sleep(0.05)
+    with executor.channel('page'):
+        executor.run('fast', lambda: None)
+    thread.join()
+    assert outcome == ['superseded'], outcome
+
+
+def check_executor_timeout_and_context():
+    """ A slow call raises QueryTimeout, and calls run in a copy of the caller's context """
+    executor = QueryExecutor(max_workers=1, timeout=5)
+    start = time.monotonic()
+    try:
+        executor.run('slow', time.sleep, 1, timeout=0.05)
+        raise AssertionError('no QueryTimeout')
+    except QueryTimeout:
+        pass
+    assert time.monotonic() - start < 0.5
+    assert executor.stats()['timeouts'] == 1
+    request = contextvars.ContextVar('request')
+    request.set('page-1')
+    assert executor.run('context', request.get) == 'page-1'
+
+
+def _publish_and_read(path: str, cycles: int, errors):
+    """ Process body of check_versioned_dir: publish new versions and read the current one """
+    try:
+        for _ in range(cycles):
+            folder = versioned_dir.new_version(path, 'check')
+            for name in ('a', 'b'):
+                with open(os.path.join(folder, name), 'w') as f:
+                    f.write(os.path.basename(folder).lstrip('.'))
+            with versioned_dir.build_lock(path):
+                versioned_dir.publish(path, folder)
+
+            def load(current):
+                with open(os.path.join(current, 'a')) as f, open(os.path.join(current, 'b')) as g:
+                    return f.read(), g.read(), os.path.basename(current)
+            a, b, name = versioned_dir.read_current(path, load)
+            assert a == b == name, (a, b, name)
+    except Exception:
+        errors.put(traceback.format_exc())
+
+
+def check_versioned_dir(processes: int, cycles: int):
+    """ Processes publishing and reading at once always read a complete current folder, and old ones are pruned """
+    with tempfile.TemporaryDirectory() as path:
+        context = multiprocessing.get_context('spawn')
+        errors = context.Queue()
+        workers = [context.Process(target=_publish_and_read, args=(path, cycles, errors)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failures = []
+        while not errors.empty():
+            failures.append(errors.get())
+        assert not failures, failures[0]
+        assert all(worker.exitcode == 0 for worker in workers)
+        published = [name for name in os.listdir(path) if name.startswith('check-')]
+        assert len(published) <= versioned_dir.KEEP_VERSIONS, published
+
+
+def _try_leader(lock_path: str, leaders, release):
+    """ Process body of check_refresher_leader """
+    refresher = Refresher([], lock_path=lock_path)
+    leaders.put(refresher.is_leader())
+    release.wait(10)
+
+
+def check_refresher_leader(processes: int):
+    """ One process holds the lock and polls, the others follow the published markers """
+    with tempfile.TemporaryDirectory() as path:
+        context = multiprocessing.get_context('spawn')
+        leaders, release = context.Queue(), context.Event()
+        workers = [context.Process(target=_try_leader, args=(os.path.join(path, 'refresh.lock'), leaders, release))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        votes = [leaders.get(timeout=30) for _ in workers]
+        release.set()
+        for worker in workers:
+            worker.join()
+        assert votes.count(True) == 1, votes
+
+        db_path = os.path.join(path, 'source.db')
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('CREATE TABLE spei (year INTEGER)')
+            conn.executemany('INSERT INTO spei VALUES (?)', [(2000,), (2001,)])
+        pool = ConnectionPool(lambda: sqlite3.connect(db_path, check_same_thread=False), name='check')
+        state_path, lock_path = os.path.join(path, 'state.json'), os.path.join(path, 'refresh.lock')
+        calls = {'leader': [], 'follower': [], 'published': []}
+
+        def make(role):
+            publisher = (lambda old, new: calls['published'].append(sorted(new))) if role == 'leader' else None
+            return Refresher([Watch('spei', pool, 'SELECT year, COUNT(*) FROM spei GROUP BY year',
+                                    lambda old, new: calls[role].append(sorted(new)), per_year=True,
+                                    publisher=publisher)], state_path=state_path, lock_path=lock_path)
+        leader, follower = make('leader'), make('follower')
+        leader.poll()
+        follower.poll()
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('DELETE FROM spei WHERE year = 2000')
+            conn.execute('INSERT INTO spei VALUES (2002)')
+        follower.poll()
+        assert calls['follower'] == [], 'a follower queried the database'
+        leader.poll()
+        follower.poll()
+        expected = [[2001, 2002]]
+        assert calls['published'] == calls['leader'] == calls['follower'] == expected, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=5)
+    parser.add_argument('--cycles', type=int, default=15)
+    args = parser.parse_args()
+
+    checks = [(check_pool_bounds, ()), (check_pool_timeout, ()), (check_pool_recycle, ()),
+              (check_executor_coalescing, ()), (check_executor_supersede, ()), (check_executor_timeout_and_context, ()),
+              (check_versioned_dir, (args.processes, args.cycles)), (check_refresher_leader, (args.processes,))]
+    failed = 0
+    for check, check_args in checks:
+        name = check.__name__
+        start = time.perf_counter()
+        try:
+            check(*check_args)
+            print(f'ok    {name} ({time.perf_counter() - start:.2f} s)')
+        except Exception:
+            failed += 1
+            print(f'FAIL  {name}\n{traceback.format_exc()}')
+    print(f'{len(checks) - failed}/{len(checks)} checks passed')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+""" Local SQLite stand-in of the drought and shapes databases, seeded with a synthetic SPEI grid and shape tables in the
+same string format (coordinates / polygon_type) as the production tables.
+
+python benchmarks/fake_db.py /tmp/drought_bench --points 60000 --years 10
+"""
+import argparse
+import functools
+import os
+import sqlite3
+import sys
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = ['Extremly dry', 'Sever dry', 'Moderate dry', 'Slight dry',
+              'Normal', 'Slight wet', 'Moderate wet', 'Sever wet', 'Extremly wet']
+BOUNDS = (44.0, 25.0, 63.0, 40.0)  # min_x, min_y, max_x, max_y
+FIRST_YEAR = 1990
+
+
+def ring_string(x0: float, y0: float, x1: float, y1: float, vertices_per_edge: int, rng, jitter: float) -> str:
+    """ Closed ring around a rectangle with jittered vertices along its edges, as "x y, x y, ..." """
+    t = np.linspace(0, 1, vertices_per_edge, endpoint=False)
+    xs = np.concatenate([x0 + (x1 - x0) * t, np.full_like(t, x1), x1 - (x1 - x0) * t, np.full_like(t, x0)])
+    ys = np.concatenate([np.full_like(t, y0), y0 + (y1 - y0) * t, np.full_like(t, y1), y1 - (y1 - y0) * t])
+    inner = np.ones(len(xs), dtype=bool)
+    inner[::vertices_per_edge] = False  # Keep the corners in place
+    xs[inner] += rng.uniform(-jitter, jitter, inner.sum()) * (np.arange(len(xs))[inner] // vertices_per_edge % 2)
+    ys[inner] += rng.uniform(-jitter, jitter, inner.sum()) * (1 - np.arange(len(xs))[inner] // vertices_per_edge % 2)
+    xs, ys = np.append(xs, xs[0]), np.append(ys, ys[0])
+    return ', '.join(f'{x:.6f} {y:.6f}' for x, y in zip(xs, ys))
+
+
+def make_shapes(conn, provinces: tuple, counties: tuple, vertices_per_edge: int, rng):
+    """ Province table of provinces[0] x provinces[1] rectangles tiling BOUNDS, every third one with an island
+    (MultiPolygon), and County table splitting each province into counties[0] x counties[1] rectangles
+    """
+    conn.execute('CREATE TABLE Province (id INTEGER, province_name TEXT, longitude REAL, latitude REAL, '
+                 'polygon_type TEXT, coordinates TEXT)')
+    conn.execute('CREATE TABLE County (id INTEGER, province_id INTEGER, province_name TEXT, county_name TEXT, '
+                 'longitude REAL, latitude REAL, polygon_type TEXT, coordinates TEXT)')
+    min_x, min_y, max_x, max_y = BOUNDS
+    width, height = (max_x - min_x) / provinces[0], (max_y - min_y) / provinces[1]
+    county_id = 0
+    for i in range(provinces[0] * provinces[1]):
+        x0, y0 = min_x + i % provinces[0] * width, min_y + i // provinces[0] * height
+        name = f'Province {i + 1:02d}'
+        coords = ring_string(x0, y0, x0 + width, y0 + height, vertices_per_edge, rng, width / vertices_per_edge / 3)
+        polygon_type = 'Polygon'
+        if i % 3 == 1:
+            island = ring_string(x0 + width * 0.4, y0 - height * 0.08, x0 + width * 0.5, y0 - height * 0.02, 8, rng, 0)
+            coords, polygon_type = f'{coords}|{island}', 'MultiPolygon'
+        conn.execute('INSERT INTO Province VALUES (?, ?, ?, ?, ?, ?)',
+                     (i, name, x0 + width / 2, y0 + height / 2, polygon_type, coords))
+        county_width, county_height = width / counties[0], height / counties[1]
+        for j in range(counties[0] * counties[1]):
+            cx0, cy0 = x0 + j % counties[0] * county_width, y0 + j // counties[0] * county_height
+            coords = ring_string(cx0, cy0, cx0 + county_width, cy0 + county_height, max(vertices_per_edge // 4, 2), rng,
+                                 county_width / vertices_per_edge)
+            conn.execute('INSERT INTO County VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (county_id, i, name, f'County {i + 1:02d}-{j + 1:02d}', cx0 + county_width / 2,
+                          cy0 + county_height / 2, 'Polygon', coords))
+            county_id += 1
+
+
+def make_spei(conn, n_points: int, n_years: int, rng):
+    """ Regular grid of about n_points points over BOUNDS with a smooth random SPEI field per year """
+    min_x, min_y, max_x, max_y = BOUNDS
+    nx = int(round(np.sqrt(n_points * (max_x - min_x) / (max_y - min_y))))
+    ny = max(n_points // nx, 1)
+    x, y = np.meshgrid(np.linspace(min_x, max_x, nx), np.linspace(min_y, max_y, ny))
+    x, y = x.ravel(), y.ravel()
+    conn.execute('CREATE TABLE spei (x REAL, y REAL, year INTEGER, value REAL)')
+    for year in range(FIRST_YEAR, FIRST_YEAR + n_years):
+        field = sum(np.sin(x / rng.uniform(1, 4) + rng.uniform(0, 6)) * np.cos(y / rng.uniform(1, 4) + rng.uniform(0, 6))
+                    for _ in range(3))
+        values = field / 1.5 + rng.normal(0, 0.5, len(x))
+        conn.executemany('INSERT INTO spei VALUES (?, ?, ?, ?)',
+                         zip(x.tolist(), y.tolist(), [year] * len(x), values.round(4).tolist()))
+    conn.execute('CREATE INDEX ix_spei_year ON spei (year)')
+
+
+def make_statistics(conn, n_years: int, rng):
+    """ Random category areas and percentages of every province and county and year """
+    conn.execute('CREATE TABLE drought_area_per_province (province TEXT, year INTEGER, category TEXT, area REAL)')
+    conn.execute('CREATE TABLE drought_percentage_per_province (province TEXT, year INTEGER, category TEXT, percentage REAL)')
+    conn.execute('CREATE TABLE drought_area_per_county (province TEXT, county TEXT, year INTEGER, category TEXT, area REAL)')
+    conn.execute('CREATE TABLE drought_percentage_per_county (province TEXT, county TEXT, year INTEGER, category TEXT, percentage REAL)')
+    regions = conn.execute('SELECT province_name, county_name FROM County').fetchall()
+    provinces = sorted({province for province, _ in regions})
+    for year in range(FIRST_YEAR, FIRST_YEAR + n_years):
+        for level, names in (('province', [(p, None) for p in provinces]), ('county', regions)):
+            areas = rng.uniform(1, 10, (len(names), len(CATEGORIES))) * (100000 if level == 'province' else 10000)
+            shares = areas / areas.sum(axis=1, keepdims=True) * 100
+            keys = [(province, county) if level == 'county' else (province,) for province, county in names]
+            conn.executemany(f'INSERT INTO drought_area_per_{level} VALUES ({", ".join("?" * (len(keys[0]) + 3))})',
+                             [(*key, year, category, float(areas[i, k]))
+                              for i, key in enumerate(keys) for k, category in enumerate(CATEGORIES)])
+            conn.executemany(f'INSERT INTO drought_percentage_per_{level} VALUES ({", ".join("?" * (len(keys[0]) + 3))})',
+                             [(*key, year, category, float(shares[i, k]))
+                              for i, key in enumerate(keys) for k, category in enumerate(CATEGORIES)])
+    conn.execute('CREATE INDEX ix_area_province ON drought_area_per_province (year, province)')
+    conn.execute('CREATE INDEX ix_area_county ON drought_area_per_county (year, county)')
+
+
+def make_database(path: str, n_points: int = 60000, n_years: int = 10, provinces: tuple = (8, 4), counties: tuple = (4, 3),
+                  vertices_per_edge: int = 200, seed: int = 0):
+    """ Create the SQLite file holding the tables of both databases """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    with sqlite3.connect(path) as conn:
+        make_shapes(conn, provinces, counties, vertices_per_edge, rng)
+        make_spei(conn, n_points, n_years, rng)
+        make_statistics(conn, n_years, rng)
+
+
+def connect(path: str):
+    """ Connection to the stand-in, with its tables under the dbo schema name like the production queries expect """
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute('ATTACH DATABASE ? AS dbo', (path,))
+    return conn
+
+
+def write_config(workdir: str, figure_cache: bool = True):
+    """ Data/config.ini of a benchmark run: local caches in the workdir, no refresh polling and no source checks """
+    data_dir = os.path.join(workdir, 'Data')
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, 'config.ini'), 'w') as f:
+        f.write(f"""[default]
+SQLDriver = sqlite
+
+[mapbox]
+token = benchmark
+
+[cache]
+MaxMemoryMB = 256
+WarmUpYears = 3
+
+[figure_cache]
+Enabled = {str(figure_cache).lower()}
+Directory = {os.path.join(workdir, 'figures')}
+
+[artifact]
+Path = {os.path.join(data_dir, 'reference')}
+CheckSource = false
+
+[store]
+Path = {os.path.join(data_dir, 'spei_store')}
+
+[refresh]
+Interval = 0
+
+[startup]
+DecodeProcesses = 2
+
+[metrics]
+SlowRequestMs = 100000
+""")
+
+
+def install(path: str):
+    """ Point the connection pools of data_collection at the stand-in; Run from the workdir, before importing the app """
+    sys.path.insert(0, REPO_DIR)
+    import data_collection as dc
+    dc.DATA_POOL.connect = dc.SHAPES_POOL.connect = functools.partial(connect, path)
+    return dc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a local SQLite stand-in of the databases and its config.ini')
+    parser.add_argument('workdir')
+    parser.add_argument('--points', type=int, default=60000)
+    parser.add_argument('--years', type=int, default=10)
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    make_database(os.path.join(args.workdir, 'drought.db'), args.points, args.years)
+    write_config(args.workdir)
+    print(os.path.join(args.workdir, 'drought.db'))
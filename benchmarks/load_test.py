@@ -0,0 +1,316 @@
+""" Load test of the dashboard on the local SQLite stand-in (fake_db.py): concurrent simulated sessions load the page,
+move the year slider, switch provinces and select an area on the map, and the latency (p50/p99), payload size and
+memory of each callback output are reported.
+
+In process, through the Flask test client:
+    python benchmarks/load_test.py --points 60000 --years 10 --sessions 40 --concurrency 8
+Against gunicorn workers started on the stand-in:
+    python benchmarks/load_test.py --gunicorn-workers 5 --sessions 40 --concurrency 8
+Against a running server (any database):
+    python benchmarks/load_test.py --url http://localhost:8050 --sessions 40 --concurrency 8
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+import fake_db  # noqa: E402
+
+
+class FlaskTransport:
+    """ Requests through one Flask test client per thread """
+
+    def __init__(self, server):
+        self.server = server
+        self._local = threading.local()
+
+    def request(self, path: str, body: dict = None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.server.test_client()
+        response = client.post(path, json=body) if body is not None else client.get(path)
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+    """ Requests to a running server """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def request(self, path: str, body: dict = None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+class Recorder:
+    """ Latency and payload size of every request, by label """
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, label: str, seconds: float, size: int, ok: bool):
+        with self._lock:
+            self.samples.setdefault(label, []).append((seconds, size))
+            if not ok:
+                self.errors[label] = self.errors.get(label, 0) + 1
+
+    def report(self) -> dict:
+        report = {}
+        for label, samples in sorted(self.samples.items()):
+            times = np.array([s[0] for s in samples]) * 1000
+            sizes = np.array([s[1] for s in samples])
+            report[label] = {
+                'requests': len(samples),
+                'errors': self.errors.get(label, 0),
+                'p50_ms': float(np.percentile(times, 50)),
+                'p99_ms': float(np.percentile(times, 99)),
+                'max_ms': float(times.max()),
+                'mean_bytes': float(sizes.mean()),
+            }
+        return report
+
+
+def find_component(layout, component_id: str):
+    """ Props of the component with the id in a Dash layout JSON """
+    if isinstance(layout, dict):
+        props = layout.get('props', {})
+        if props.get('id') == component_id:
+            return props
+        children = props.get('children')
+        for child in children if isinstance(children, list) else [children]:
+            found = find_component(child, component_id)
+            if found is not None:
+                return found
+    return None
+
+
+class Session:
+    """ One simulated user driving the callbacks of the page like the browser does """
+
+    def __init__(self, transport, recorder: Recorder, rng: random.Random):
+        self.transport = transport
+        self.recorder = recorder
+        self.rng = rng
+        self.state = {}
+
+    def get(self, path: str, label: str):
+        start = time.perf_counter()
+        status, data = self.transport.request(path)
+        self.recorder.add(label, time.perf_counter() - start, len(data), status == 200)
+        return data
+
+    def callback(self, output: str, inputs: list, state: list = ()):
+        """ Call the callback of output with the current values of the input and state properties """
+        def props(names):
+            return [{'id': name.split('.')[0], 'property': name.split('.')[1], 'value': self.state.get(name)} for name in names]
+        component, prop = output.split('.')
+        body = {'output': output, 'outputs': {'id': component, 'property': prop},
+                'inputs': props(inputs), 'state': props(state), 'changedPropIds': [inputs[0]]}
+        start = time.perf_counter()
+        status, data = self.transport.request('/_dash-update-component', body)
+        self.recorder.add(output, time.perf_counter() - start, len(data), status in (200, 204))
+        if status == 200:
+            self.state[output] = json.loads(data)['response'][component][prop]
+
+    def year_changed(self):
+        self.callback('selected_year.children', ['select_year.value'])
+        self.callback('year_values.data', ['select_year.value', 'selected_province.value'], ['session_id.data'])
+        self.callback('region_stacked.figure', ['select_year.value', 'selected_province.value'])
+        self.callback('pie_chart.figure', ['select_year.value', 'selected_province.value', 'selected_county.value'])
+        self.callback('selection_chart.figure', ['drought_graph.selectedData', 'select_year.value'], ['session_id.data'])
+
+    def province_changed(self):
+        self.callback('map_base.data', ['selected_province.value', 'selected_shape.value'],
+                      ['select_year.value', 'session_id.data'])
+        self.callback('selected_county.options', ['selected_province.value'])
+        self.callback('selected_county.disabled', ['selected_province.value'])
+        self.callback('category_stacked.figure', ['selected_province.value'])
+        self.year_changed()
+
+    def run(self, slider_moves: int = 5):
+        self.get('/', 'page')
+        layout = json.loads(self.get('/_dash-layout', 'layout'))
+        slider = find_component(layout, 'select_year')
+        provinces = [option['value'] for option in find_component(layout, 'selected_province')['options']]
+        self.state.update({'select_year.value': slider['value'], 'selected_province.value': 'country',
+                           'selected_shape.value': 'country', 'selected_county.value': 'country',
+                           'drought_graph.selectedData': None,
+                           'session_id.data': find_component(layout, 'session_id')['data']})
+        self.province_changed()
+        for _ in range(slider_moves):
+            self.state['select_year.value'] = self.rng.randint(slider['min'], slider['max'])
+            self.year_changed()
+        self.state['selected_province.value'] = self.rng.choice(provinces)
+        self.state['selected_shape.value'] = self.rng.choice(['country', 'province', 'county'])
+        self.province_changed()
+        self.state['drought_graph.selectedData'] = {'range': {'mapbox': [[50, 30], [55, 35]]}}
+        self.callback('selection_chart.figure', ['drought_graph.selectedData', 'select_year.value'], ['session_id.data'])
+
+
+def rss_kb(pid: int) -> dict:
+    """ Current and peak resident memory of a process, from /proc """
+    values = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS', 'VmHWM')):
+                key, value = line.split(':')
+                values[key] = int(value.split()[0])
+    return values
+
+
+def child_pids(pid: int) -> list:
+    pids = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(name))
+            except (OSError, IndexError, ValueError):
+                continue
+    return pids
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir: str, db_path: str, workers: int, threads: int):
+    port = free_port()
+    env = dict(os.environ, BENCH_DB=db_path,
+               PYTHONPATH=os.pathsep.join([BENCH_DIR, fake_db.REPO_DIR, os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                                '-b', f'127.0.0.1:{port}', '--timeout', '300', 'bench_app:server'],
+                               cwd=workdir, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 600
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited')
+        try:
+            with urllib.request.urlopen(url + '/', timeout=5):
+                return process, url
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def run_sessions(transport, sessions: int, concurrency: int, slider_moves: int, seed: int):
+    recorder = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [pool.submit(Session(transport, recorder, random.Random(seed + i)).run, slider_moves)
+                   for i in range(sessions)]
+        for future in futures:
+            future.result()
+    return recorder, time.perf_counter() - start
+
+
+def prepare(workdir: str, db_path: str, store: bool):
+    """ Build the reference data snapshot (and the SPEI store) once, before the server starts """
+    os.chdir(workdir)
+    fake_db.install(db_path)
+    import artifact
+    import grid_store
+    start = time.perf_counter()
+    artifact.build_artifact(fingerprint='benchmark')
+    if store:
+        grid_store.build_store()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the dashboard on a local SQLite stand-in of the databases')
+    parser.add_argument('--points', type=int, default=60000)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--slider-moves', type=int, default=5)
+    parser.add_argument('--workdir', help='reuse the database and caches of this folder (created if missing)')
+    parser.add_argument('--store', action='store_true', help='build and use the memory-mapped SPEI store')
+    parser.add_argument('--no-figure-cache', action='store_true')
+    parser.add_argument('--gunicorn-workers', type=int, default=0, help='run gunicorn on the stand-in instead of the test client')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--url', help='load test a running server instead')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file, to compare releases')
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    results = {'args': vars(args)}
+    if args.url:
+        transport, server_process = HttpTransport(args.url), None
+    else:
+        workdir = args.workdir or tempfile.mkdtemp(prefix='drought_bench-')
+        workdir = os.path.abspath(workdir)
+        os.makedirs(workdir, exist_ok=True)
+        db_path = os.path.join(workdir, 'drought.db')
+        if not os.path.exists(db_path):
+            start = time.perf_counter()
+            fake_db.make_database(db_path, args.points, args.years)
+            print(f'Seeded {db_path} in {time.perf_counter() - start:.1f} s')
+        fake_db.write_config(workdir, figure_cache=not args.no_figure_cache)
+        results['prepare_seconds'] = prepare(workdir, db_path, args.store)
+        if args.gunicorn_workers:
+            server_process, url = start_gunicorn(workdir, db_path, args.gunicorn_workers, args.threads)
+            transport = HttpTransport(url)
+        else:
+            start = time.perf_counter()
+            import drought_heatmap
+            results['startup_seconds'] = time.perf_counter() - start
+            transport, server_process = FlaskTransport(drought_heatmap.server), None
+
+    try:
+        recorder, elapsed = run_sessions(transport, args.sessions, args.concurrency, args.slider_moves, args.seed)
+        if server_process is not None:
+            results['memory_kb'] = {pid: rss_kb(pid) for pid in child_pids(server_process.pid)}
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+    if not args.url and not args.gunicorn_workers:
+        results['memory_kb'] = {os.getpid(): {'VmHWM': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}
+
+    results['outputs'] = recorder.report()
+    total = sum(r['requests'] for r in results['outputs'].values())
+    results['requests_per_second'] = total / elapsed
+    print(f'{args.sessions} sessions, {args.concurrency} concurrent: {total} requests in {elapsed:.1f} s '
+          f'({results["requests_per_second"]:.1f} req/s)')
+    print(f'{"output":<28}{"requests":>9}{"errors":>7}{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}{"mean KB":>10}')
+    for label, r in results['outputs'].items():
+        print(f'{label:<28}{r["requests"]:>9}{r["errors"]:>7}{r["p50_ms"]:>9.1f}{r["p99_ms"]:>9.1f}{r["max_ms"]:>9.1f}'
+              f'{r["mean_bytes"] / 1024:>10.1f}')
+    for pid, memory in results.get('memory_kb', {}).items():
+        print(f'pid {pid}: ' + ', '.join(f'{key} {value / 1024:.0f} MB' for key, value in memory.items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import numpy as np
+import shapely
+import shapely.wkt
 from shapely.geometry import Polygon, MultiPolygon
 import pyodbc
 import logging
@@ -7,6 +9,15 @@ import pandas as pd
 import geopandas as gpd
 import configparser
 import os
+from db_pool import ConnectionPool
+from queries import run_query, fetch_arrays
+from tracing import traced, add_stage
+from query_executor import QueryExecutor
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 DATA_DIR = 'Data'
@@ -14,34 +25,148 @@ logger = logging.getLogger(__name__)
 config = configparser.ConfigParser()
 config.read(os.path.join(DATA_DIR, 'config.ini'))
 
-DATA_CONN_STRING = f"""
-                        Driver={config['default']['SQLDriver']};
-                        Server={config['drought']['DroughtServer']};
-                        Database={config['drought']['DroughtDatabase']};
-                        uid={config['drought']['DroughtUser']};
-                        pwd={config['drought']['DroughtPWD']};
-                    """
-
-SHAPES_CONN_STRING = f"""
-                            Driver={config['default']['SQLDriver']};
-                            Server={config['shapes']['ShapesServer']};
-                            Database={config['shapes']['ShapesDatabase']};
-                            uid={config['shapes']['ShapesUser']};
-                            pwd={config['shapes']['ShapesPWD']};
-                        """
-
-CENTERS_QUERY = '''select
-                    c.province_name,
-                    c.county_name,
-                    c.longitude as county_lon,
-                    c.latitude as county_lat,
-                    p.longitude as province_lon,
-                    p.latitude as province_lat
-                from
-                    dbo.County c left join dbo.Province p on c.province_id = p.id
-                '''
+
+
+def make_conn_string(section: str, prefix: str) -> str:
+    """ Build the ODBC connection string for a database section of config.ini"""
+    return f"""
+                Driver={config.get('default', 'SQLDriver', fallback='')};
+                Server={config.get(section, f'{prefix}Server', fallback='')};
+                Database={config.get(section, f'{prefix}Database', fallback='')};
+                uid={config.get(section, f'{prefix}User', fallback='')};
+                pwd={config.get(section, f'{prefix}PWD', fallback='')};
+            """
+
+
+DATA_CONN_STRING = make_conn_string('drought', 'Drought')
+SHAPES_CONN_STRING = make_conn_string('shapes', 'Shapes')
+
+POOL_SETTINGS = {
+    'max_size': config.getint('pool', 'MaxSize', fallback=5),
+    'idle_timeout': config.getfloat('pool', 'IdleTimeout', fallback=300),
+    'max_lifetime': config.getfloat('pool', 'MaxLifetime', fallback=3600),
+    'checkout_timeout': config.getfloat('pool', 'CheckoutTimeout', fallback=30),
+}
+DATA_POOL = ConnectionPool(lambda: pyodbc.connect(DATA_CONN_STRING), name='drought', timer=add_stage, **POOL_SETTINGS)
+SHAPES_POOL = ConnectionPool(lambda: pyodbc.connect(SHAPES_CONN_STRING), name='shapes', timer=add_stage, **POOL_SETTINGS)
+
+# Queries of the request threads run on a bounded executor, with a timeout, sharing the result of identical queries in flight
+QUERY_EXECUTOR = QueryExecutor(max_workers=config.getint('executor', 'Workers', fallback=POOL_SETTINGS['max_size']),
+                               timeout=config.getfloat('executor', 'QueryTimeout', fallback=30))
+
 SHAPE_FILES = {'province': 'Province', 'county': 'County'}
 
+# Simplification tolerance (degrees, about half a pixel) and coordinate decimals of the map layers at each zoom level
+SIMPLIFY_LEVELS = {'country': {'tolerance': 0.02, 'decimals': 3},
+                   'province': {'tolerance': 0.01, 'decimals': 4}}
+
+# Optional rowversion column of the source tables, whose maximum changes on every insert or update. Without it the
+# markers are row counts, so values updated in place without adding or removing rows are not detected.
+ROWVERSION_COLUMN = config.get('refresh', 'RowVersionColumn', fallback='')
+_ROWVERSION_MARKER = f', MAX(CAST({ROWVERSION_COLUMN} AS BIGINT))' if ROWVERSION_COLUMN else ''
+
+# Cheap queries whose results change when the source tables change, polled by the background refresh.
+# The spei and statistics queries return one row per year (year first), so only the changed years are reloaded;
+# they read the year index only, instead of checksumming every row.
+CHANGE_MARKER_QUERIES = {
+    'spei': f'SELECT year, COUNT(*){_ROWVERSION_MARKER} FROM dbo.spei GROUP BY year',
+    'statistics': [f'SELECT year, COUNT(*){_ROWVERSION_MARKER} FROM dbo.{table} GROUP BY year'
+                   for table in ('drought_area_per_province', 'drought_percentage_per_province',
+                                 'drought_area_per_county', 'drought_percentage_per_county')],
+    'shapes': [f'SELECT COUNT(*), MAX(id){_ROWVERSION_MARKER} FROM dbo.{table}' for table in SHAPE_FILES.values()],
+}
+
+# Processes decoding the shape tables on startup (0 or 1 decodes in the loading thread), and the minimum rows per process
+STARTUP_PROCESSES = config.getint('startup', 'DecodeProcesses', fallback=min(4, os.cpu_count() or 1))
+MIN_ROWS_PER_PROCESS = 50
+
+# Types of the columnar SPEI data
+SPEI_DTYPES = {'x': np.float32, 'y': np.float32, 'year': np.int16, 'value': np.float32}
+
+# Size limit of the per-year SPEI cache and the number of recent years loaded on startup
+CACHE_MAX_MB = config.getint('cache', 'MaxMemoryMB', fallback=256)
+CACHE_WARM_UP_YEARS = config.getint('cache', 'WarmUpYears', fallback=0)
+
+
+class YearCache:
+    """ LRU cache of the SPEI grid of each year, kept as float32 x, y and value arrays """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, year):
+        """ Return the (x, y, value) arrays of the year or None, marking the year as recently used """
+        with self._lock:
+            arrays = self._items.get(year)
+            if arrays is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(year)
+            self.hits += 1
+            return arrays
+
+    def put(self, year, arrays):
+        """ Store the arrays of the year and evict the least recently used years above the memory cap """
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            logger.warning(f'Year {year} ({size} bytes) is larger than the cache limit, not cached')
+            return
+        with self._lock:
+            if year in self._items:
+                self.nbytes -= sum(a.nbytes for a in self._items.pop(year))
+            self._items[year] = arrays
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                old_year, old_arrays = self._items.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in old_arrays)
+                self.evictions += 1
+                logger.debug(f'Evicted year {old_year} from the SPEI cache')
+
+    def typical_rows(self):
+        """ Number of points of a cached year (the grid is the same every year), or None if the cache is empty """
+        with self._lock:
+            for arrays in self._items.values():
+                return len(arrays[0])
+        return None
+
+    def discard(self, year):
+        """ Remove the year from the cache if it is cached """
+        with self._lock:
+            arrays = self._items.pop(year, None)
+            if arrays is not None:
+                self.nbytes -= sum(a.nbytes for a in arrays)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """ Hit/miss counters and memory usage of the cache """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'years': list(self._items),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+
+spei_cache = YearCache(CACHE_MAX_MB * 1024 * 1024)
+
+# Memory-mapped grid_store.GridStore of the SPEI series, set on startup when the store is built
+spei_store = None
+
 
 def make_polygon(coords: str, geometry: str):
     """ Convert the string formatted polygons in data base back to Polygon"""
@@ -63,95 +188,286 @@ def make_polygon(coords: str, geometry: str):
     return coord_poly
 
 
-def load_data(year: int):
-    """ Read the drought index values from database for the input year"""
-    conn = pyodbc.connect(DATA_CONN_STRING)
-    df = pd.read_sql_query(f'SELECT x, y, year, value FROM dbo.spei WHERE year={year}', conn)
-    return df
+def decode_geometries(coords: pd.Series, geometry_types: pd.Series) -> np.ndarray:
+    """ Convert all the string formatted polygons of a table to Polygon/MultiPolygon in one vectorized pass.
+    Produces the same geometries as applying make_polygon to every row.
+    """
+    geometry_types = geometry_types.to_numpy()
+    unknown = set(geometry_types) - {'Polygon', 'MultiPolygon'}
+    if unknown:
+        raise ValueError(f'Unsupported geometry types: {unknown}')
+    is_multi = geometry_types == 'MultiPolygon'
+
+    """ Split the rows into rings (only MultiPolygons have several rings) and count the vertices of each ring """
+    rings = coords.str.split('|')
+    n_rings = rings.str.len().to_numpy()
+    if (n_rings[~is_multi] > 1).any():
+        raise ValueError('Polygon rows can not have several rings')
+    rings = rings.explode()
+    n_vertices = rings.str.count(',').to_numpy() + 1
+
+    """ Parse all the vertices of the table at once """
+    values = np.array(' '.join(rings.str.replace(',', ' ', regex=False)).split(), dtype=np.float64)
+    if values.size != 2 * n_vertices.sum():
+        raise ValueError('Coordinates must be pairs of "x y" separated by commas')
+    values = values.reshape(-1, 2)
+
+    if hasattr(shapely, 'polygons'):
+        ring_index = np.repeat(np.arange(len(n_vertices)), n_vertices)
+        parts = shapely.polygons(shapely.linearrings(values, indices=ring_index))
+    else:
+        """ Shapely < 2 has no vectorized constructors, build from the parsed arrays instead of strings """
+        offsets = np.concatenate([[0], np.cumsum(n_vertices)])
+        parts = np.empty(len(n_vertices), dtype=object)
+        parts[:] = [Polygon(values[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    geometries = np.empty(len(geometry_types), dtype=object)
+    first_ring = np.concatenate([[0], np.cumsum(n_rings)[:-1]])
+    geometries[~is_multi] = parts[first_ring[~is_multi]]
+    if is_multi.any():
+        part_row = np.repeat(np.arange(len(geometry_types)), n_rings)
+        multi_parts = is_multi[part_row]
+        if hasattr(shapely, 'multipolygons'):
+            _, multi_index = np.unique(part_row[multi_parts], return_inverse=True)
+            geometries[is_multi] = shapely.multipolygons(parts[multi_parts], indices=multi_index)
+        else:
+            row_parts = np.split(parts, np.cumsum(n_rings)[:-1])
+            geometries[is_multi] = [MultiPolygon(list(row_parts[i])) for i in np.flatnonzero(is_multi)]
+    return geometries
+
+
+@traced()
+def load_data(year: int, executor=QUERY_EXECUTOR):
+    """ Read the drought index values for the input year, from the SPEI store if it has the year, otherwise from the cache or the database on a miss.
+    executor (QueryExecutor): Runs the query of a miss with the request timeout; None runs it in the calling thread
+        without a timeout, for the startup and background refresh loads.
+    """
+    if spei_store is not None and year in spei_store:
+        arrays = spei_store.year_arrays(year)
+    else:
+        arrays = spei_cache.get(year)
+    if arrays is None:
+        columns = fetch_arrays(DATA_POOL, 'spei_year', SPEI_DTYPES, (int(year),), expected_rows=spei_cache.typical_rows(),
+                               executor=executor)
+        arrays = (columns['x'], columns['y'], columns['value'])
+        spei_cache.put(year, arrays)
+    x, y, value = arrays
+    return pd.DataFrame({'x': x, 'y': y, 'year': year, 'value': value})
+
+
+@traced()
+def fetch_years(years: list) -> dict:
+    """ Read the drought index values of several years from database in a single query, as typed columns {'x', 'y', 'year', 'value'}"""
+    placeholders = ', '.join('?' * len(years))
+    return fetch_arrays(DATA_POOL, 'spei_years', SPEI_DTYPES, tuple(int(year) for year in years),
+                        sql=f'SELECT x, y, year, value FROM dbo.spei WHERE year IN ({placeholders})',
+                        expected_rows=(spei_cache.typical_rows() or 0) * len(years) or None)
+
+
+@traced()
+def load_data_columns(years: list) -> dict:
+    """ Read the drought index values of several years as typed columns {'x', 'y', 'year', 'value'},
+    from the SPEI store or the cache, fetching all the other years in a single query
+    """
+    years = [int(year) for year in years]
+    cached = {}
+    for year in years:
+        if spei_store is not None and year in spei_store:
+            cached[year] = spei_store.year_arrays(year)
+        else:
+            cached[year] = spei_cache.get(year)
+    missing = [year for year, arrays in cached.items() if arrays is None]
+    if missing:
+        columns = fetch_years(missing)
+        for year in missing:
+            mask = columns['year'] == year
+            cached[year] = (columns['x'][mask], columns['y'][mask], columns['value'][mask])
+            spei_cache.put(year, cached[year])
+    return {
+        'x': np.concatenate([cached[year][0] for year in years]),
+        'y': np.concatenate([cached[year][1] for year in years]),
+        'year': np.concatenate([np.full(len(cached[year][0]), year, dtype=SPEI_DTYPES['year']) for year in years]),
+        'value': np.concatenate([cached[year][2] for year in years]),
+    }
 
 
+@traced()
 def load_years():
     """ Load a list of all the years that have drought data in spei table; Returns a list"""
-    conn = pyodbc.connect(DATA_CONN_STRING)
-    df = pd.read_sql_query('SELECT DISTINCT year FROM dbo.spei', conn)
+    df = run_query(DATA_POOL, 'years')
     return df['year'].unique().tolist()
 
 
+def warm_up_cache(n_years: int = CACHE_WARM_UP_YEARS, years: list = None):
+    """ Load the n most recent years into the SPEI cache; Returns the list of loaded years"""
+    if n_years <= 0:
+        return []
+    if years is None:
+        years = load_years()
+    recent = sorted(years, reverse=True)[:n_years]
+    for year in recent:
+        load_data(year, executor=None)
+    logger.info(f'SPEI cache warmed up with years {recent}: {spei_cache.stats()["bytes"]} bytes')
+    return recent
+
+
 def load_counties():
     """ Create a dict with province_name as key and a list of all of it's counties"""
-    conn = pyodbc.connect(SHAPES_CONN_STRING)
-    df = pd.read_sql_query('SELECT province_name, county_name FROM dbo.County', conn)
+    df = run_query(SHAPES_POOL, 'counties')
     return df.groupby('province_name')['county_name'].apply(list).to_dict()
 
 
+def read_shape_table(type_name: str) -> pd.DataFrame:
+    """ Read the string formatted shapes of a type in SHAPE_FILES from database"""
+    logger.debug(f'Sending query for dbo.{SHAPE_FILES.get(type_name)}')
+    df = run_query(SHAPES_POOL, f'shapes_{type_name}',
+                   sql=f'''SELECT {type_name}_name, polygon_type, coordinates FROM dbo.{SHAPE_FILES.get(type_name)}''')
+    logger.debug(f'Shape set is read: {type_name}')
+    return df
+
+
+def shapes_to_geojson(df: pd.DataFrame, type_name: str) -> dict:
+    """ Change the string formatted shapes to json formatted geometries required by scatter_mapbox, with the shape names as feature ids"""
+    df = df.assign(geometry=decode_geometries(df['coordinates'], df['polygon_type']))
+    gdf = gpd.GeoDataFrame(df).set_index(f'{type_name}_name')
+    return json.loads(gdf.geometry.to_json())
+
+
+def load_centroids() -> dict:
+    """ Create a list of all Provinces and Counties and their centers for the drop down menu and map center """
+    df_county_list = run_query(SHAPES_POOL, 'centers')
+    centroids = {}
+    for type_name in SHAPE_FILES:
+        centroids[type_name] = df_county_list[[f'{type_name}_name', f'{type_name}_lon', f'{type_name}_lat']].rename(columns={f'{type_name}_lon': 'center_x', f'{type_name}_lat': 'center_y'}).drop_duplicates(keep='first')
+    return centroids
+
+
+@traced()
 def load_shapes(SHAPE_FILES: dict = SHAPE_FILES):
     """ Load shapes, shape centers and province list from database.
     Output: 
     shape_files (dict): Each shape type and corresponding json formatted geometry of shapes
     centroids (dict): The X and Y coordinates for the center of each shape
     """
-    conn = pyodbc.connect(SHAPES_CONN_STRING)
-    shape_files = {}
-    centroids = {}
+    shape_files = {type_name: shapes_to_geojson(read_shape_table(type_name), type_name) for type_name in SHAPE_FILES}
+    return shape_files, load_centroids()
 
-    for type_name in SHAPE_FILES:
-        logger.debug(f'Sending query for dbo.{SHAPE_FILES.get(type_name)}')
-        df = pd.read_sql_query(f'''SELECT id, {type_name}_name, longitude, latitude, province_name as province, polygon_type, coordinates
-                                FROM dbo.{SHAPE_FILES.get(type_name)}''', conn)
-        logger.debug(f'Shape set is read: {type_name}')
-        df['geometry'] = df.apply(lambda x: make_polygon(x.coordinates, x.polygon_type), axis=1)
-        gdf = gpd.GeoDataFrame(df)
 
-        """ Change geometries to json formatted required by scatter_mapbox"""
-        shape_files[type_name] = json.loads(gdf.geometry.to_json())
+def _decode_chunk(df: pd.DataFrame, type_name: str) -> dict:
+    """ GeoJSON FeatureCollection of a chunk of a shape table; Runs in the decoding processes """
+    return shapes_to_geojson(df, type_name)
 
-    """ Create a list of all Provinces and Counties and their centers for the drop down menu and map center """
-    df_county_list = pd.read_sql_query(CENTERS_QUERY, conn)
-    for type_name in SHAPE_FILES:
-        centroids[type_name] = df_county_list[[f'{type_name}_name', f'{type_name}_lon', f'{type_name}_lat']].rename(columns={f'{type_name}_lon': 'center_x', f'{type_name}_lat': 'center_y'}).drop_duplicates(keep='first')
-    conn.close()
-    return shape_files, centroids
-
-
-def load_province_category(province):
-    """ Return the percentage of categories for selected province """
-    conn = pyodbc.connect(DATA_CONN_STRING)
-    if province == 'country':
-        # TODO: Change the query to country percentage when ready and remove the calculations
-        df = pd.read_sql_query(f"SELECT * FROM dbo.drought_area_per_province", conn)
-        total_area = df.groupby(['year'])['area'].sum().reset_index().iloc[0,1]
-        df = df.groupby(['year', 'category'])['area'].sum().reset_index()
-        df['total'] = total_area
-        df['percentage'] = (df['area']/df['total'])*100
-        df.drop(columns=['area', 'total'], inplace=True)
-    else:
-        df = pd.read_sql_query(f"SELECT * FROM dbo.drought_percentage_per_province WHERE province LIKE N'{province}'", conn)
-    df = df[df['year'] >= df['year'].max() - 20]
-    return df
 
+def _merge_collections(collections: list) -> dict:
+    """ One FeatureCollection of the chunks, with the bbox of all of them like shapes_to_geojson of the whole table """
+    merged = {'type': 'FeatureCollection', 'features': [f for collection in collections for f in collection['features']]}
+    boxes = np.array([collection['bbox'] for collection in collections if 'bbox' in collection])
+    if len(boxes):
+        merged['bbox'] = [*boxes[:, :2].min(axis=0).tolist(), *boxes[:, 2:].max(axis=0).tolist()]
+    return merged
 
-def load_region_year(year, province):
-    """ Return all the category percentages of the region for the selected year"""
-    conn = pyodbc.connect(DATA_CONN_STRING)
-    if province == 'country':
-        df = pd.read_sql_query(f"SELECT * FROM dbo.drought_percentage_per_province WHERE year = {year} ORDER BY province DESC", conn)
+
+def _process_context():
+    """ Start method of the decoding processes: forkserver (spawn on Windows), because forking the loading process
+    while its other threads hold database connections and logging locks would copy them in a locked state
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    # Imported once by the server process, which forks the decoding processes from it already loaded
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def load_startup_data(processes: int = STARTUP_PROCESSES):
+    """ Load shapes, centroids, counties and years, running the queries of both databases concurrently
+    and decoding the large shape tables in a process pool.
+    Output:
+    shape_files (dict), centroids (dict): Same as load_shapes
+    counties (dict): Same as load_counties
+    years (list): Same as load_years
+    timings (dict): Seconds spent in each query and decoding stage, and in total
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    def timed(name, func, *args):
+        stage_start = time.perf_counter()
+        result = func(*args)
+        timings[name] = time.perf_counter() - stage_start
+        return result
+
+    decoder = ProcessPoolExecutor(processes, mp_context=_process_context()) if processes > 1 else None
+
+    def decode(type_name, table):
+        df = table.result()
+        n_chunks = min(processes, len(df) // MIN_ROWS_PER_PROCESS)
+        if decoder is None or n_chunks < 2:
+            return timed(f'decode_{type_name}', shapes_to_geojson, df, type_name)
+        stage_start = time.perf_counter()
+        chunks = [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), n_chunks)]
+        collection = _merge_collections(list(decoder.map(_decode_chunk, chunks, [type_name] * n_chunks)))
+        timings[f'decode_{type_name}'] = time.perf_counter() - stage_start
+        return collection
+
+    try:
+        with ThreadPoolExecutor(max_workers=2 * len(SHAPE_FILES) + 3) as executor:
+            tables = {t: executor.submit(timed, f'query_{t}', read_shape_table, t) for t in SHAPE_FILES}
+            shapes = {t: executor.submit(decode, t, table) for t, table in tables.items()}
+            centroids = executor.submit(timed, 'query_centroids', load_centroids)
+            counties = executor.submit(timed, 'query_counties', load_counties)
+            years = executor.submit(timed, 'query_years', load_years)
+            shape_files = {t: future.result() for t, future in shapes.items()}
+            result = shape_files, centroids.result(), counties.result(), years.result()
+    finally:
+        if decoder is not None:
+            decoder.shutdown()
+    timings['total'] = time.perf_counter() - start
+    logger.info('Startup data loaded in ' + ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in timings.items()))
+    return (*result, timings)
+
+
+def simplify_shapes(geojson: dict, tolerance: float, decimals: int) -> dict:
+    """ Simplify the shapes of a GeoJSON FeatureCollection keeping the borders shared by neighbours, and round the coordinates """
+    features = geojson['features']
+    geometries = np.empty(len(features), dtype=object)
+    geometries[:] = [shapely.geometry.shape(f['geometry']) for f in features]
+    geometries = gpd.GeoSeries(simplify_coverage(geometries, tolerance), index=[f.get('id') for f in features])
+    if hasattr(shapely, 'transform'):
+        geometries = gpd.GeoSeries(shapely.transform(geometries.values, lambda coords: np.round(coords, decimals)),
+                                   index=geometries.index)
     else:
-        df = pd.read_sql_query(f"""SELECT 
-                                county, percentage, category, year 
-                                FROM dbo.drought_percentage_per_county 
-                                WHERE year = {year} and province like N'{province}' ORDER BY county DESC""",
-                                conn)
-        df.rename(columns={'county': 'province'}, inplace=True)
-    return df
+        geometries = geometries.apply(lambda geom: shapely.wkt.loads(shapely.wkt.dumps(geom, rounding_precision=decimals)))
+    return json.loads(geometries.to_json())
 
 
-def load_region_year_pie(year, region, level):
-    """ Return category area values for a selected region (Country, Province, County) and year"""
-    query_strings = {
-                    0: f"SELECT * FROM dbo.drought_area_per_province WHERE YEAR={year} AND province LIKE N'تهران'", # TODO: After getting the data change to Country query
-                    1: f"SELECT * FROM dbo.drought_area_per_province WHERE YEAR={year} AND province LIKE N'{region}'",
-                    2: f"SELECT * FROM dbo.drought_area_per_county WHERE YEAR={year} AND county LIKE N'{region}'"
-                    }
-    conn = pyodbc.connect(DATA_CONN_STRING)
-    df = pd.read_sql_query(query_strings[level], conn)
-    return df
+def simplify_coverage(geometries: np.ndarray, tolerance: float) -> np.ndarray:
+    """ Simplify the shapes of a layer (provinces or counties) as a coverage: every border shared by two neighbours is
+    simplified once for both, so no gaps or slivers open between them (shapely >= 2.1).
+    Falls back to simplifying each shape on its own, keeping its topology, on older shapely or when the shapes overlap
+    (not a valid coverage); Shared borders may then drift apart at coarse tolerances.
+    """
+    if hasattr(shapely, 'coverage_simplify'):
+        if shapely.coverage_is_valid(geometries):
+            return shapely.coverage_simplify(geometries, tolerance)
+        logger.warning('The shapes are not a valid coverage (they overlap or their shared borders differ), '
+                       'simplifying each shape on its own')
+    return np.array([geometry.simplify(tolerance, preserve_topology=True) for geometry in geometries], dtype=object)
+
+
+def simplify_shape_levels(shape_files: dict, levels: dict = SIMPLIFY_LEVELS) -> dict:
+    """ Simplified versions of all the shape types for each zoom level.
+    Output:
+    layers (dict): {zoom level: {shape type: json formatted geometry of shapes}}
+    """
+    return {level: {type_name: simplify_shapes(geojson, **settings) for type_name, geojson in shape_files.items()}
+            for level, settings in levels.items()}
+
+
+@traced()
+def load_region_statistics(min_year: int = None) -> dict:
+    """ Read the area and percentage tables of the provinces and counties, optionally only from min_year on """
+    min_year = 0 if min_year is None else int(min_year)
+    return {name: run_query(DATA_POOL, f'{name}_stats', (min_year,))
+            for name in ('province_area', 'province_percentage', 'county_area', 'county_percentage')}
+
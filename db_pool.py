@@ -0,0 +1,215 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection could be checked out of the pool in time """
+
+
+class ConnectionPool:
+    """ Bounded, thread-safe pool of reusable database connections for a single DSN.
+
+    connect (callable): Function with no arguments returning a new DB-API connection,
+        e.g. lambda: pyodbc.connect(DSN) or lambda: sqlite3.connect(path) for local testing.
+    max_size (int): Maximum number of open connections.
+    idle_timeout (float): Seconds after which an unused connection is closed instead of reused.
+    max_lifetime (float): Seconds after which a connection is recycled regardless of use.
+    checkout_timeout (float): Seconds to wait for a free connection before raising PoolTimeout.
+    health_check_after (float): Connections idle for longer than this are checked with health_query before use.
+    max_cursors (int): Cursors kept per connection by cached_cursor, the least recently used ones are closed.
+    timer (callable): Called as timer(stage, seconds) with the checkout wait ('checkout:{name}') and the time to open
+        each new connection ('connect:{name}'), e.g. tracing.add_stage.
+    """
+
+    def __init__(self, connect, name: str = 'pool', max_size: int = 5, idle_timeout: float = 300,
+                 max_lifetime: float = 3600, checkout_timeout: float = 30,
+                 health_check_after: float = 30, health_query: str = 'SELECT 1', max_cursors: int = 16, timer=None):
+        self.connect = connect
+        self.name = name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self.health_query = health_query
+        self.max_cursors = max_cursors
+        self.timer = timer
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        """ Forget all connections, used at creation and after a fork (gunicorn workers) """
+        self._pid = os.getpid()
+        self._idle = []  # (connection, created, last_used), most recently used last
+        self._created_at = {}
+        self._cursors = {}
+        self._open = 0
+        self.metrics = {
+            'created': 0,
+            'checkouts': 0,
+            'recycled': 0,
+            'failed_health_checks': 0,
+            'timeouts': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    @contextmanager
+    def connection(self):
+        """ Check out a connection for the duration of the with block """
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def _checkout(self):
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        conn = None
+        while conn is None:
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._reset()
+                while not self._idle and self._open >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.metrics['timeouts'] += 1
+                        raise PoolTimeout(f'{self.name}: no free connection after {self.checkout_timeout}s')
+                    self._cond.wait(remaining)
+                if self._idle:
+                    idle = self._idle.pop()
+                else:
+                    self._open += 1
+                    idle = None
+
+            # Health checks and new connections are round trips to the server, made without holding the lock
+            if idle is not None:
+                conn = self._check_idle(*idle)
+                continue
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+
+        waited = time.monotonic() - start
+        if self.timer is not None:
+            self.timer(f'checkout:{self.name}', waited)
+        with self._cond:
+            self.metrics['checkouts'] += 1
+            self.metrics['wait_total'] += waited
+            self.metrics['wait_max'] = max(self.metrics['wait_max'], waited)
+        return conn
+
+    def _check_idle(self, conn, created: float, last_used: float):
+        """ Return the idle connection if it is still usable, otherwise close it and return None """
+        now = time.monotonic()
+        if now - created > self.max_lifetime or now - last_used > self.idle_timeout:
+            self._discard(conn, 'recycled')
+            return None
+        if now - last_used > self.health_check_after and not self._is_healthy(conn):
+            self._discard(conn, 'failed_health_checks')
+            return None
+        return conn
+
+    def _new_connection(self):
+        start = time.monotonic()
+        conn = self.connect()
+        if self.timer is not None:
+            self.timer(f'connect:{self.name}', time.monotonic() - start)
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self.metrics['created'] += 1
+        logger.debug(f'{self.name}: opened a new connection')
+        return conn
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            logger.warning(f'{self.name}: connection failed the health check')
+            return False
+
+    def cached_cursor(self, conn, key: str):
+        """ Cursor of a checked out connection reused for the same key (the query text), so drivers that keep the
+        last prepared statement per cursor (pyodbc) don't prepare the query again.
+        Keeps the max_cursors most recently used cursors of the connection, as query texts built from a variable number
+        of parameters (IN lists) are all different keys.
+        """
+        cursors = self._cursors.setdefault(id(conn), OrderedDict())
+        cursor = cursors.get(key)
+        if cursor is not None:
+            cursors.move_to_end(key)
+            return cursor
+        cursor = cursors[key] = conn.cursor()
+        while len(cursors) > self.max_cursors:
+            _, old_cursor = cursors.popitem(last=False)
+            try:
+                old_cursor.close()
+            except Exception:
+                pass
+        return cursor
+
+    def _discard(self, conn, reason: str = None):
+        """ Release the slot of a connection and close it; Called without the lock held, as closing may wait on the server """
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._cursors.pop(id(conn), None)
+            self._open -= 1
+            if reason is not None:
+                self.metrics[reason] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkin(self, conn, broken: bool = False):
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            if not broken:
+                created = self._created_at.get(id(conn), time.monotonic())
+                self._idle.append((conn, created, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def close_all(self):
+        """ Close all idle connections """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        """ Pool size and checkout metrics """
+        with self._cond:
+            stats = dict(self.metrics)
+            stats['open'] = self._open
+            stats['idle'] = len(self._idle)
+            stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            return stats
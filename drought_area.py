@@ -0,0 +1,141 @@
+""" Drought area statistics computed from the SPEI grid: every value is classified into the drought categories and the
+cell area of its point is summed per region, year and category for all the years in one batched pass.
+
+The output has the same tables as data_collection.load_region_statistics, so it can fill the statistics cube directly
+(Source = grid in the [statistics] section of config.ini), or be exported to replace the precomputed tables:
+    python drought_area.py export Data/statistics
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_collection as dc
+import grid_store
+import regions
+import stats_cube
+
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE_LAT = 110574
+METERS_PER_DEGREE_LON = 111320  # At the equator, times cos(latitude)
+SQUARE_METERS_PER_HECTARE = 10000
+
+# Degrees between two grid points (x, y); Inferred from the coordinates when not set
+CELL_SIZE = tuple(float(v) for v in dc.config.get('statistics', 'CellSize', fallback='').split(',') if v.strip()) or None
+
+
+def grid_spacing(coords: np.ndarray) -> float:
+    """ Most common distance between consecutive distinct coordinates of a regular grid """
+    steps = np.diff(np.unique(np.round(coords, 6)))
+    if not len(steps):
+        return 0.0
+    values, counts = np.unique(np.round(steps, 6), return_counts=True)
+    return float(values[np.argmax(counts)])
+
+
+def cell_areas(x: np.ndarray, y: np.ndarray, cell_size: tuple = CELL_SIZE) -> np.ndarray:
+    """ Area in hectares of the grid cell around each point, narrowing with the latitude """
+    dx, dy = cell_size or (grid_spacing(x), grid_spacing(y))
+    width = dx * METERS_PER_DEGREE_LON * np.cos(np.radians(y))
+    return (width * dy * METERS_PER_DEGREE_LAT / SQUARE_METERS_PER_HECTARE).astype(np.float64)
+
+
+def category_areas(codes: np.ndarray, n_regions: int, categories: np.ndarray, areas: np.ndarray) -> np.ndarray:
+    """ Total area of each (region, year, category) from the region code of each point (OUTSIDE for none)
+    and the category of each (year, point) value (-1 for no value)
+    """
+    n_years = categories.shape[0]
+    n_categories = len(regions.CATEGORIES)
+    valid = (codes >= 0)[None, :] & (categories >= 0)
+    year_index = np.broadcast_to(np.arange(n_years)[:, None], categories.shape)
+    keys = (codes[None, :].astype(np.int64) * n_years + year_index) * n_categories + categories
+    weights = np.broadcast_to(areas[None, :], categories.shape)
+    totals = np.bincount(keys[valid], weights=weights[valid], minlength=n_regions * n_years * n_categories)
+    return totals.reshape(n_regions, n_years, n_categories)
+
+
+def to_table(area: np.ndarray, level: str, names: list, years: list) -> tuple:
+    """ Long (region, year, category, area) and (region, year, category, percentage) tables of the non empty cells """
+    total = area.sum(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentage = area / total * 100
+    region, year, category = np.nonzero(area)
+    keys = {
+        level: np.asarray(names, dtype=object)[region],
+        'year': np.asarray(years)[year],
+        'category': np.asarray(regions.CATEGORIES, dtype=object)[category],
+    }
+    return (pd.DataFrame({**keys, 'area': area[region, year, category]}),
+            pd.DataFrame({**keys, 'percentage': percentage[region, year, category]}))
+
+
+def county_provinces(index: regions.RegionIndex) -> list:
+    """ Province of each county of the index, the one holding most of its points (None for counties without points) """
+    county, province = index.codes['county'], index.codes['province']
+    n_counties, n_provinces = len(index.names['county']), len(index.names['province'])
+    inside = (county >= 0) & (province >= 0)
+    counts = np.bincount(county[inside] * n_provinces + province[inside],
+                         minlength=n_counties * n_provinces).reshape(n_counties, n_provinces)
+    return [index.names['province'][i] if counts[c, i] else None for c, i in enumerate(counts.argmax(axis=1))]
+
+
+def region_statistics(index: regions.RegionIndex, years: list, values: np.ndarray, areas: np.ndarray = None) -> dict:
+    """ Area and percentage tables of every category per country, province and county and year.
+    values (np.ndarray): (years x points) SPEI values, the points in the order of the index (NaN for no value).
+    Returns the tables of data_collection.load_region_statistics, plus country_area and country_percentage.
+    """
+    areas = cell_areas(index.x, index.y) if areas is None else areas
+    categories = regions.classify(values)
+    tables = {}
+    country_codes = np.where(index.codes['province'] >= 0, 0, regions.OUTSIDE)
+    for level, codes, names in (('country', country_codes, [stats_cube.COUNTRY]),
+                                ('province', index.codes['province'], index.names['province']),
+                                ('county', index.codes['county'], index.names['county'])):
+        area = category_areas(codes, len(names), categories, areas)
+        tables[f'{level}_area'], tables[f'{level}_percentage'] = to_table(area, level, names, years)
+    parents = dict(zip(index.names['county'], county_provinces(index)))
+    tables['county_percentage'].insert(0, 'province', tables['county_percentage']['county'].map(parents))
+    return tables
+
+
+def year_matrix(index: regions.RegionIndex, years: list) -> np.ndarray:
+    """ (years x points) values of the years in the order of the index points, read with data_collection.load_data_columns """
+    columns = dc.load_data_columns(years)
+    rows = np.searchsorted(np.asarray(years), columns['year'])
+    points = index.point_ids(columns['x'], columns['y'])
+    found = points >= 0
+    values = np.full((len(years), len(index)), np.nan, dtype=np.float32)
+    values[rows[found], points[found]] = columns['value'][found]
+    return values
+
+
+def grid_statistics(index: regions.RegionIndex, years: list = None) -> dict:
+    """ Statistics tables of the years (all the years of dbo.spei by default) computed from the SPEI grid """
+    start = time.perf_counter()
+    years = sorted(int(year) for year in (years if years is not None else dc.load_years()))
+    tables = region_statistics(index, years, year_matrix(index, years))
+    logger.info(f'Drought statistics of {len(years)} years x {len(index)} points computed in {time.perf_counter() - start:.2f} s')
+    return tables
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the drought area statistics tables from the SPEI grid')
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('directory', help='folder of the CSV files, one per table')
+    args = parser.parse_args()
+    dc.spei_store = grid_store.open_store()
+    if dc.spei_store is not None:
+        x, y = dc.spei_store.x, dc.spei_store.y
+    else:
+        columns = dc.load_data_columns([max(dc.load_years())])
+        x, y = columns['x'], columns['y']
+    index = regions.RegionIndex(x, y, dc.load_shapes()[0])
+    os.makedirs(args.directory, exist_ok=True)
+    for name, df in grid_statistics(index).items():
+        df.to_csv(os.path.join(args.directory, f'{name}.csv'), index=False)
+        print(f'{name}: {len(df)} rows')
@@ -8,12 +8,31 @@ Created on Tue Jul 27 13:27:37 2021
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import plotly.express as px
+import numpy as np
+import pandas as pd
 import flask
+import functools
 import json
 import logging
+import os
+import uuid
+from typing import NamedTuple
 import data_collection as dc
+import artifact
+import db_pool
+import drought_area
+import grid
+import grid_store
+import queries
+import query_executor
+import regions
+import stats_cube
+import tracing
+from figure_cache import FigureCache, DEFAULT_DIRECTORY
+from refresher import Refresher, Watch, changed_years, removed_years
 
 
 logging.basicConfig(level=logging.DEBUG, filename='main.log', format='%(asctime)s :: %(name)s :: %(levelname)s :: %(message)s')
@@ -22,9 +41,15 @@ logger = logging.getLogger(__name__)
 
 ZOOM_LEVELS = {'country': 5, 'province': 6.2}
 
+# Points closer than this many pixels are merged, and province views only show points this many degrees around the province
+GRID_PIXELS_PER_CELL = dc.config.getfloat('grid', 'PixelsPerCell', fallback=2)
+GRID_BOUNDS_MARGIN = dc.config.getfloat('grid', 'BoundsMargin', fallback=0.2)
+
+# 'database' reads the precomputed statistics tables, 'grid' computes them from the SPEI values (drought_area)
+STATISTICS_SOURCE = dc.config.get('statistics', 'Source', fallback='database')
+
 # Stacked bar chart order and corresponding colors
-CATEGORY_ORDER = {'category': ['Extremly dry', 'Sever dry', 'Moderate dry', 'Slight dry', 
-                   'Normal', 'Slight wet', 'Moderate wet', 'Sever wet', 'Extremly wet']}
+CATEGORY_ORDER = {'category': regions.CATEGORIES}
 
 CATEGORY_COLOR = ['#610000', '#d60000', '#d65900', '#fae902', 
                   '#1bd402',
@@ -32,19 +57,114 @@ CATEGORY_COLOR = ['#610000', '#d60000', '#d65900', '#fae902',
 
 COLOR_MAP = {x[0]: x[1] for x in zip(CATEGORY_ORDER['category'], CATEGORY_COLOR)}
 
-shapes, centroids = dc.load_shapes()
+class AppState(NamedTuple):
+    """ Reference data, lookups derived from it and data versions read by the callbacks.
+    Never modified: the background refresh builds a new one and swaps it in with a single assignment of state,
+    so a callback reading state once sees a consistent set.
+    """
+    shapes: dict
+    centroids: dict
+    all_counties: dict
+    years: list
+    shape_layers: dict
+    province_list: list
+    province_centers: dict
+    province_bounds: dict
+    region_index: regions.RegionIndex
+    year_versions: dict
+    shapes_version: object
+
+
+def publish_spei(old: dict, new: dict):
+    """ Update the changed years in the SPEI store shared by the workers; Run by the polling process only """
+    if grid_store.open_store() is not None:
+        grid_store.update_store(changed_years(old, new))
+
+
+def refresh_spei(old: dict, new: dict):
+    """ Drop the changed (and deleted) years from the SPEI cache, reopen the SPEI store and update the years of the slider """
+    global state
+    current = state
+    updated = changed_years(old, new)
+    for year in updated:
+        dc.spei_cache.discard(year)
+    region_index = current.region_index
+    if dc.spei_store is not None:
+        dc.spei_store = grid_store.open_store()
+        if len(dc.spei_store.x) != len(region_index):
+            region_index = build_region_index(current.shapes, current.years)
+    if STATISTICS_SOURCE == 'grid':
+        reloaded = [year for year in updated if year in new]
+        if reloaded:
+            stats.update(drought_area.grid_statistics(region_index, reloaded))
+        stats.remove_years(removed_years(old, new))
+    state = current._replace(years=sorted(new), year_versions=new, region_index=region_index)
+    fig_cache.prune([figure_generation(year) for year in state.years])
+
+
+def refresh_statistics(old: dict, new: dict):
+    """ Reload the statistics of the changed years into the cube, and drop the deleted ones """
+    updated = changed_years(old, new)
+    if updated:
+        stats.update(dc.load_region_statistics(min_year=updated[0]))
+    stats.remove_years(removed_years(old, new))
+
+
+def publish_shapes(old, new):
+    """ Rebuild the reference data snapshot shared by the workers; Run by the polling process only """
+    artifact.build_artifact()
+
+
+def refresh_shapes(old, new):
+    """ Switch to the rebuilt reference data snapshot """
+    global state
+    new_state = build_state(artifact.load_artifact() or artifact.load_reference_data(), state.year_versions, new)
+    if STATISTICS_SOURCE == 'grid':
+        stats.update(drought_area.grid_statistics(new_state.region_index))
+    state = new_state
+    fig_cache.prune([figure_generation(year) for year in state.years])
+
+
+""" Poll the change markers of the source tables in the background. One worker polls the databases and rebuilds the
+shared files, the others follow the markers it publishes. The first poll runs before loading the data, so the data
+loaded below is at least as recent as the markers this worker starts from.
+"""
+data_refresher = Refresher([
+    Watch('spei', dc.DATA_POOL, dc.CHANGE_MARKER_QUERIES['spei'], refresh_spei, per_year=True, publisher=publish_spei),
+    *([Watch('statistics', dc.DATA_POOL, dc.CHANGE_MARKER_QUERIES['statistics'], refresh_statistics, per_year=True)]
+      if STATISTICS_SOURCE == 'database' else []),
+    Watch('shapes', dc.SHAPES_POOL, dc.CHANGE_MARKER_QUERIES['shapes'], refresh_shapes, publisher=publish_shapes),
+    ], interval=dc.config.getfloat('refresh', 'Interval', fallback=300),
+    state_path=dc.config.get('refresh', 'StatePath', fallback=os.path.join(dc.DATA_DIR, 'refresh_state.json')),
+    lock_path=dc.config.get('refresh', 'LockPath', fallback=os.path.join(dc.DATA_DIR, 'refresh.lock')))
+if data_refresher.interval > 0:
+    data_refresher.poll()
+
+
+def build_state(data: tuple, year_versions: dict, shapes_version) -> AppState:
+    """ State of the reference data and the lookups derived from it; Used on startup and by the background refresh """
+    shapes, centroids, all_counties, years, shape_layers = data
+
+    """ A list of provinces for dropdown"""
+    province_list = [{'label': x ,'value': x} for x in centroids['province']['province_name']]
+    province_list.append({'label': 'همه', 'value':'country'})
+
+    """A dict of centers for setting the center value in map by province name"""
+    province_centers = {x.loc['province_name']: json.dumps({'lat': x.loc['center_y'], 'lon': x.loc['center_x']}) for _, x in centroids['province'].iterrows()}
+    province_centers['country'] = json.dumps({'lat': 32.7089, 'lon': 53.6880})
 
-""" A list of provinces for dropdown"""
-province_list = [{'label': x ,'value': x} for x in centroids['province']['province_name']]
-province_list.append({'label': 'همه', 'value':'country'})
+    """A dict of bounding boxes for clipping the points of the map by province name"""
+    province_bounds = grid.shape_bounds(shapes['province'])
 
-"""A dict of centers for setting the center value in map by province name"""
-province_centers = {x.loc['province_name']: json.dumps({'lat': x.loc['center_y'], 'lon': x.loc['center_x']}) for _, x in centroids['province'].iterrows()}
-province_centers['country'] = json.dumps({'lat': 32.7089, 'lon': 53.6880})
+    """ A dict of counties, with each province as a key and corresponding counties as values """
+    all_counties['country'] = []
+
+    """ Province and county of every point of the grid, for the statistics of the map selection """
+    region_index = build_region_index(shapes, years)
+
+    return AppState(shapes, centroids, all_counties, years, shape_layers, province_list, province_centers,
+                    province_bounds, region_index, year_versions, shapes_version)
 
-""" A dict of counties, with each province as a key and corresponding counties as values """
-all_counties = dc.load_counties()
-all_counties['country'] = []
 
 def create_slider_marks(years: list) -> dict:
     """
@@ -61,32 +181,207 @@ def create_slider_marks(years: list) -> dict:
 """ Read Mapbox token from file """
 mb_token = dc.config['mapbox']['token']
 
-""" Load the data """
-years = dc.load_years()
+def build_region_index(shapes: dict, years: list) -> regions.RegionIndex:
+    """ Assign the points of the SPEI grid (the store's point index, or the points of the last year) to the provinces and counties """
+    if dc.spei_store is not None:
+        x, y = dc.spei_store.x, dc.spei_store.y
+    else:
+        df = dc.load_data(max(years), executor=None)
+        x, y = df['x'].to_numpy(), df['y'].to_numpy()
+    return regions.RegionIndex(x, y, shapes)
+
+
+""" Load the data, from the local SPEI store when it is built """
+dc.spei_store = grid_store.open_store()
+
+""" Reference data from the local snapshot, rebuilt from the databases when missing or stale """
+state = build_state(artifact.load_reference_data(), data_refresher.markers.get('spei', {}), data_refresher.markers.get('shapes'))
+if dc.spei_store is None:
+    dc.warm_up_cache(years=state.years)
+
+""" Serialized map figures shared between the workers """
+fig_cache = FigureCache(dc.config.get('figure_cache', 'Directory', fallback=DEFAULT_DIRECTORY),
+                        compress=dc.config.getboolean('figure_cache', 'Compress', fallback=True),
+                        version=dc.config.get('figure_cache', 'Version', fallback=''),
+                        enabled=dc.config.getboolean('figure_cache', 'Enabled', fallback=True),
+                        max_bytes=dc.config.getint('figure_cache', 'MaxMB', fallback=512) * 1024 * 1024)
+
+def load_statistics() -> stats_cube.StatsCube:
+    """ Statistics cube from the statistics tables, or computed from the SPEI grid with Source = grid in [statistics] """
+    if STATISTICS_SOURCE == 'grid':
+        cube = stats_cube.StatsCube()
+        cube.update(drought_area.grid_statistics(state.region_index))
+        return cube
+    return stats_cube.load_cube()
+
+
+""" Drought statistics of all regions for the bar and pie charts """
+stats = load_statistics()
+
+
+if data_refresher.interval > 0:
+    data_refresher.start()
 
 """ Initiate Dash App """
 server = flask.Flask(__name__)
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets, server=server)
 
+""" Latency histograms of the callbacks and the caches' stats on /metrics """
+tracing.install(server,
+                slow_ms=dc.config.getfloat('metrics', 'SlowRequestMs', fallback=1000),
+                profile_dir=dc.config.get('metrics', 'ProfileDir', fallback='Data/profiles') if dc.config.getboolean('metrics', 'Profile', fallback=False) else None,
+                allow_remote=dc.config.getboolean('metrics', 'AllowRemote', fallback=False),
+                callback_outputs=lambda: app.callback_map)
+tracing.register_stats('spei_cache', dc.spei_cache.stats)
+tracing.register_stats('figure_cache', fig_cache.stats)
+tracing.register_stats('drought_pool', dc.DATA_POOL.stats)
+tracing.register_stats('shapes_pool', dc.SHAPES_POOL.stats)
+tracing.register_stats('queries', queries.query_stats)
+tracing.register_stats('query_executor', dc.QUERY_EXECUTOR.stats)
+
+
+def latest_only(func):
+    """ For callbacks with the page's session_id as last State: a newer call of the callback from the same page
+    cancels this one's queries still waiting for the database, and this call sends no update.
+    When a query or the wait for a pooled connection times out, the page keeps its current output (no_update) instead of
+    getting an error response.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        *values, session_id = args
+        with dc.QUERY_EXECUTOR.channel((session_id, func.__name__)):
+            try:
+                return func(*values)
+            except query_executor.Superseded:
+                raise PreventUpdate
+            except (query_executor.QueryTimeout, db_pool.PoolTimeout) as e:
+                logger.warning(f'{func.__name__} sends no update: {e}')
+                tracing.count('query_timeouts', func.__name__)
+                return dash.no_update
+    return wrapper
+
 
 @app.callback(
-    Output('drought_graph', 'figure'),
+    Output('map_base', 'data'),
     [Input('selected_province', 'value'),
-     Input('select_year', 'value'),
      Input('selected_shape', 'value'),
-     ]
+     ],
+    [State('select_year', 'value'),
+     State('session_id', 'data')]
     )
+@tracing.traced_callback()
+@latest_only
 def update_fig(center,
-               select_year=max(years),
-               selected_shape='country'
+               selected_shape='country',
+               select_year=None
                ):
+    """ Return the figure from the figure cache, building and caching it on a miss.
+    Only sent when the province or the boundary level changes; year changes only send the point values (update_year_values)
+    """
+    current = state
+    select_year = select_year or max(current.years)
+    key, generation = figure_key(center, select_year, selected_shape), figure_generation(select_year, current)
+    with tracing.stage('figure_cache_get'):
+        fig = fig_cache.get(key, generation)
+    tracing.count('figure_cache', 'miss' if fig is None else 'hit')
+    if fig is None:
+        fig = build_figure(center, select_year, selected_shape, current)
+        with tracing.stage('figure_cache_put'):
+            fig_cache.put(key, fig, generation)
+    return {'view': center, 'figure': fig}
+
+
+@app.callback(
+    Output('year_values', 'data'),
+    [Input('select_year', 'value'),
+     Input('selected_province', 'value'),
+     ],
+    State('session_id', 'data')
+    )
+@tracing.traced_callback()
+@latest_only
+def update_year_values(select_year, center):
+    """ Encoded values of the map points for the selected year, in the same order as the points of the figure """
+    df_year = view_points(center, select_year)
+    return {'view': center, 'year': select_year, **grid.encode_values(df_year['value'].to_numpy())}
+
+
+""" Apply the values of the selected year to the map figure in the browser """
+app.clientside_callback(
+    """
+    function(base, values) {
+        if (!base) {
+            return window.dash_clientside.no_update;
+        }
+        var figure = base.figure;
+        var points = figure.data[0];
+        if (!values || values.view !== base.view) {
+            return figure;
+        }
+        var raw = atob(values.data);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) {
+            bytes[i] = raw.charCodeAt(i);
+        }
+        var scaled = new Int16Array(bytes.buffer);
+        if (Array.isArray(points.lat) && points.lat.length !== scaled.length) {
+            return figure;
+        }
+        var colors = new Float32Array(scaled.length);
+        for (var j = 0; j < scaled.length; j++) {
+            colors[j] = scaled[j] === values.missing ? NaN : scaled[j] / values.scale;
+        }
+        var trace = Object.assign({}, points, {marker: Object.assign({}, points.marker, {color: colors})});
+        return Object.assign({}, figure, {data: [trace].concat(figure.data.slice(1))});
+    }
+    """,
+    Output('drought_graph', 'figure'),
+    [Input('map_base', 'data'),
+     Input('year_values', 'data'),
+     ]
+    )
+
+
+def figure_key(center, select_year, selected_shape) -> tuple:
+    """ Figure cache key of the map inputs """
+    return (select_year, center, selected_shape)
+
+
+def figure_generation(select_year, current: AppState = None) -> tuple:
+    """ Change markers of the year and the shapes, and the number of grid points, so changed figures are rebuilt and
+    the old ones pruned
+    """
+    current = current or state
+    return (select_year, current.year_versions.get(select_year), current.shapes_version, len(current.region_index))
+
+
+@tracing.traced()
+def view_points(center, select_year, current: AppState = None):
+    """ The points of the year shown on the map for the selected province (or country).
+    Every point of the grid (region_index) is kept, with NaN where the year has no value, so the points of all the
+    years aggregate to the same cells and the values of a year line up with the figure built for another year.
+    """
+    current = current or state
+    zoom_type = ZOOM_LEVELS['country' if center == 'country' else 'province']
+    df = dc.load_data(select_year)
+    index = current.region_index
+    points = pd.DataFrame({'x': index.x, 'y': index.y, 'year': select_year,
+                           'value': index.align(df['x'].to_numpy(), df['y'].to_numpy(), df['value'].to_numpy())})
+    return grid.downsample_for_view(points, zoom_type,
+                                    bounds=current.province_bounds.get(center),
+                                    margin=GRID_BOUNDS_MARGIN,
+                                    pixels_per_cell=GRID_PIXELS_PER_CELL)
+
+
+@tracing.traced()
+def build_figure(center, select_year, selected_shape, current: AppState = None):
     """ Create the figure """
-    df_year = dc.load_data(select_year)
-    if center == 'country':
-        zoom_type = ZOOM_LEVELS['country']
-    else:
-        zoom_type = ZOOM_LEVELS['province']
+    current = current or state
+    zoom_level = 'country' if center == 'country' else 'province'
+    zoom_type = ZOOM_LEVELS[zoom_level]
+    layers = current.shape_layers[zoom_level]
+    df_year = view_points(center, select_year, current)
 
     fig = px.scatter_mapbox(df_year,
                             lat='y', lon='x',
@@ -96,7 +391,7 @@ def update_fig(center,
                             labels={'value': 'شاخص خشکسالی'},
                             zoom=zoom_type,
                             height=800, width=1050,
-                            center=json.loads(province_centers[center]),
+                            center=json.loads(current.province_centers[center]),
                             color_continuous_scale=px.colors.diverging.RdYlGn,
                             color_continuous_midpoint=0,
                             )
@@ -108,7 +403,7 @@ def update_fig(center,
         fig.update_layout(mapbox={
                                 'layers': [
                                             {
-                                            'source': shapes[selected_shape],
+                                            'source': layers[selected_shape],
                                             'below': '',
                                             'type': 'line',
                                             'color': 'black',
@@ -117,7 +412,7 @@ def update_fig(center,
                                         ]
                                 }
                         )
-        fig2 = px.scatter_mapbox(centroids[selected_shape],
+        fig2 = px.scatter_mapbox(current.centroids[selected_shape],
                     lat='center_y',
                     lon='center_x',
                     hover_data={
@@ -133,14 +428,14 @@ def update_fig(center,
         fig.update_layout(mapbox={
                         'layers': [
                                     {
-                                    'source': shapes[selected_shape],
+                                    'source': layers[selected_shape],
                                     'below': '',
                                     'type': 'line',
                                     'color': 'purple',
                                     'line': {'width': 1}
                                     },
                                     {
-                                    'source': shapes['province'],
+                                    'source': layers['province'],
                                     'below': '',
                                     'type': 'line',
                                     'color': 'black',
@@ -149,7 +444,7 @@ def update_fig(center,
                                 ]
                         }
                 )
-        fig2 = px.scatter_mapbox(centroids[selected_shape],
+        fig2 = px.scatter_mapbox(current.centroids[selected_shape],
                                  lat='center_y',
                                  lon='center_x',
                                  hover_data={
@@ -167,6 +462,7 @@ def update_fig(center,
     Output('selected_year', 'children'),
     Input('select_year', 'value')
     )
+@tracing.traced_callback()
 def updated_selected_year(value):
     """ Update the Year number showing on the subtitle according to slider """
     return f'سال {value}'
@@ -176,15 +472,17 @@ def updated_selected_year(value):
     Output('selected_county', 'options'),
     Input('selected_province', 'value')
 )
+@tracing.traced_callback()
 def update_county_list(province):
     """ Create the list of conunties to be shown on dropdown based on selected province"""
-    return [{'label': name, 'value': name} for name in all_counties[province]]
+    return [{'label': name, 'value': name} for name in state.all_counties[province]]
 
 
 @app.callback(
     Output('selected_county', 'disabled'),
     Input('selected_province', 'value')
 )
+@tracing.traced_callback()
 def enable_county_dropdown(province):
     """Enable the county drop down if a single province is selected"""
     return province == 'country'
@@ -194,8 +492,10 @@ def enable_county_dropdown(province):
     Output('category_stacked', 'figure'),
     Input('selected_province', 'value')
 )
+@tracing.traced_callback()
 def update_category_bar(province):
-    df = dc.load_province_category(province)
+    with tracing.stage('stats_cube'):
+        df = stats.province_category(province)
     fig = px.bar(df, x='year', y='percentage', color='category',
                 category_orders=CATEGORY_ORDER,
                 color_discrete_sequence=CATEGORY_COLOR,
@@ -216,8 +516,10 @@ def update_category_bar(province):
     [Input('select_year', 'value'),
     Input('selected_province', 'value')]
 )
+@tracing.traced_callback()
 def update_region_bar(year, province):
-    df = dc.load_region_year(year, province)
+    with tracing.stage('stats_cube'):
+        df = stats.region_year(year, province)
     fig = px.bar(df, x='percentage', y='province', color='category', orientation='h',
                 height=800, width=1050,
                 category_orders=CATEGORY_ORDER, 
@@ -242,6 +544,7 @@ def update_region_bar(year, province):
         Input('selected_county', 'value')
     ]
 )
+@tracing.traced_callback()
 def update_pie_chart(year, province, county):
     if province == 'country':
         level = 0
@@ -253,7 +556,8 @@ def update_pie_chart(year, province, county):
         level = 2
         region = county
         
-    df = dc.load_region_year_pie(year, region, level)
+    with tracing.stage('stats_cube'):
+        df = stats.region_area(year, region, level)
     fig = px.pie(df, values='area', names='category', color='category',
              color_discrete_map=COLOR_MAP, hole=0, 
              hover_data=['area'],
@@ -274,67 +578,119 @@ def update_pie_chart(year, province, county):
     return fig
 
 
-app.layout = html.Div(children=[
-    html.H2(children='نقشه وضعیت خشکسالی', style={'margin-left': '300px'}),
+@app.callback(
+    Output('selection_chart', 'figure'),
+    [Input('drought_graph', 'selectedData'),
+     Input('select_year', 'value')],
+    State('session_id', 'data')
+)
+@tracing.traced_callback()
+@latest_only
+def update_selection_chart(selected_data, year):
+    """ Share of each drought category of all the grid points inside the box or lasso selection of the map """
+    geometry = regions.selection_geometry(selected_data)
+    if geometry is None:
+        df = pd.DataFrame({'category': regions.CATEGORIES, 'points': 0, 'percentage': 0.0})
+        title = 'برای آمار یک محدوده، آن را روی نقشه انتخاب کنید'
+    else:
+        region_index = state.region_index
+        df = region_index.selection_summary(geometry, region_values(year, region_index))
+        title = f'{year} - {df["points"].sum()} نقطه'
+    fig = px.bar(df, x='category', y='percentage', color='category',
+                 category_orders=CATEGORY_ORDER,
+                 color_discrete_map=COLOR_MAP,
+                 labels={'percentage': 'درصد از کل', 'category': 'وضعیت'},
+                 height=400, width=1050)
+    fig.update_layout(title=dict(text=title, x=0.5, y=0.95, xanchor='center', yanchor='top'))
+    fig.update_layout(font_family='Tahoma', legend_font_family='Tahoma', showlegend=False)
+    fig.update_layout(hoverlabel=dict(font_family='Tahoma'))
+    fig.update_layout(font=dict(color="#909497"))
+    fig.update_traces(hovertemplate='%{y:.2f}<br>')
+    return fig
+
+
+@tracing.traced()
+def region_values(year, region_index: regions.RegionIndex) -> np.ndarray:
+    """ Values of the year in the order of the points of region_index """
+    df = dc.load_data(year)
+    return region_index.align(df['x'].to_numpy(), df['y'].to_numpy(), df['value'].to_numpy())
+
+
+def serve_layout():
+    """ Build the page on every load, so new pages get the years added by the background refresh """
+    current = state
+    return html.Div(children=[
+        html.H2(children='نقشه وضعیت خشکسالی', style={'margin-left': '300px'}),
     
-    html.Div(children=[
-        html.Div(id='selected_year', style={'margin-left': '450px'}),
-        html.Div(dcc.Slider(id='select_year',
-                            min=min(years),
-                            max=max(years),
-                            step=1,
-                            marks=create_slider_marks(years),
-                            value=max(years),
-                            ),
-                 style={'width': '1000px'}),
-                ]),
-    html.Div(dcc.RadioItems(id='selected_shape',
-                          options=[
-                              {'label': 'شهرستان', 'value': 'county'},
-                              {'label': 'استان', 'value': 'province'},
-                              {'label': 'کشور', 'value': 'country'}
-                              ],
-                          value='country',
-                          className='radiobutton-group',
-                          labelStyle={'display': 'inline-block'}
-                          ),
-             style={'width': '200px', 'margin-left': '400px', 'align-text': 'center', 'margin-top': '10px'}
-             ),
-
-    html.Div(dcc.Dropdown(id='selected_province',
-                          options=province_list,
-                          value='country',
-                          clearable=False
-                          ),
-             style={'width': '200px', 'margin-left': '400px', 'margin-top': '10px', 'direction': 'rtl'}
-             ),
-
-    html.Div(dcc.Dropdown(id='selected_county',
-                            options=province_list,
-                            value='country',
-                            clearable=False
-                            ),
-            style={'width': '200px', 'margin-left': '400px', 'margin-top': '10px'}
-                            ),
-
-    html.Div(dcc.Graph(id='drought_graph'),
-             style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
-             ),
+        html.Div(children=[
+            html.Div(id='selected_year', style={'margin-left': '450px'}),
+            html.Div(dcc.Slider(id='select_year',
+                                min=min(current.years),
+                                max=max(current.years),
+                                step=1,
+                                marks=create_slider_marks(current.years),
+                                value=max(current.years),
+                                ),
+                     style={'width': '1000px'}),
+                    ]),
+        html.Div(dcc.RadioItems(id='selected_shape',
+                              options=[
+                                  {'label': 'شهرستان', 'value': 'county'},
+                                  {'label': 'استان', 'value': 'province'},
+                                  {'label': 'کشور', 'value': 'country'}
+                                  ],
+                              value='country',
+                              className='radiobutton-group',
+                              labelStyle={'display': 'inline-block'}
+                              ),
+                 style={'width': '200px', 'margin-left': '400px', 'align-text': 'center', 'margin-top': '10px'}
+                 ),
+
+        html.Div(dcc.Dropdown(id='selected_province',
+                              options=current.province_list,
+                              value='country',
+                              clearable=False
+                              ),
+                 style={'width': '200px', 'margin-left': '400px', 'margin-top': '10px', 'direction': 'rtl'}
+                 ),
+
+        html.Div(dcc.Dropdown(id='selected_county',
+                                options=current.province_list,
+                                value='country',
+                                clearable=False
+                                ),
+                style={'width': '200px', 'margin-left': '400px', 'margin-top': '10px'}
+                                ),
+
+        dcc.Store(id='session_id', data=uuid.uuid4().hex),
+        dcc.Store(id='map_base'),
+        dcc.Store(id='year_values'),
+
+        html.Div(dcc.Graph(id='drought_graph'),
+                 style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
+                 ),
     
-    html.Div(dcc.Graph(id='category_stacked'),
-            style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
-            ),
+        html.Div(dcc.Graph(id='selection_chart'),
+                 style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
+                 ),
+
+        html.Div(dcc.Graph(id='category_stacked'),
+                style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
+                ),
             
-    html.Div(dcc.Graph(id='region_stacked'),
-        style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
-            ),
+        html.Div(dcc.Graph(id='region_stacked'),
+            style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
+                ),
 
-    html.Div(dcc.Graph(id='pie_chart'),
-        style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
-            )
-                         ],
-    style={'font-family': 'tahoma'}
-    )
+        html.Div(dcc.Graph(id='pie_chart'),
+            style={'text-align': 'center', 'margin-left': '25px', 'margin-top': '20px'}
+                )
+                             ],
+        style={'font-family': 'tahoma'}
+        )
+
+
+app.layout = serve_layout
 
 
 if __name__ == '__main__':
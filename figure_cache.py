@@ -0,0 +1,201 @@
+""" Cache of serialized map figures shared by all the gunicorn workers through a local directory.
+
+Pre-render the most used figures after loading new data:
+    python figure_cache.py --years 3 --clear
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# /dev/shm is memory backed on Linux, so the workers share the figures without touching the disk
+DEFAULT_DIRECTORY = '/dev/shm/drought_figures' if os.path.isdir('/dev/shm') else os.path.join('Data', 'figure_cache')
+
+
+class FigureCache:
+    """ Store plotly figures as (optionally zlib compressed) JSON files keyed by the figure inputs.
+
+    Each figure also has a generation, the versions of the data it was built from (e.g. the year and its change marker);
+    prune removes the figures of the generations that are no longer current. Above max_bytes the least recently used
+    figures are removed.
+
+    directory (str): Folder holding the cached figures, shared between workers.
+    compress (bool): Compress the JSON before writing it.
+    version (str): Part of every key; change it to invalidate all the figures built with older code or data.
+    enabled (bool): When False get always misses and put does nothing.
+    max_bytes (int): Size limit of the folder, None for no limit.
+    """
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, compress: bool = True, version: str = '', enabled: bool = True,
+                 max_bytes: int = None):
+        self.directory = directory
+        self.compress = compress
+        self.version = version
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pruned = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def _generation_name(self, generation: tuple) -> str:
+        return hashlib.sha1(json.dumps([self.version, *generation], default=str).encode('utf-8')).hexdigest()[:12]
+
+    def _path(self, key: tuple, generation: tuple = ()) -> str:
+        digest = hashlib.sha1(json.dumps([self.version, *generation, *key], ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+        name = f'{self._generation_name(generation)}-{digest}'
+        return os.path.join(self.directory, name + ('.json.z' if self.compress else '.json'))
+
+    def get_json(self, key: tuple, generation: tuple = ()):
+        """ Return the serialized figure of the key as a JSON string, or None if it is not cached """
+        if not self.enabled:
+            return None
+        path = self._path(key, generation)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time is the last use, for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        if self.compress:
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    def get(self, key: tuple, generation: tuple = ()):
+        """ Return the figure of the key as a dict, or None if it is not cached """
+        data = self.get_json(key, generation)
+        return None if data is None else json.loads(data)
+
+    def put(self, key: tuple, fig, generation: tuple = ()):
+        """ Serialize the figure (plotly Figure or JSON string) and store it under the key """
+        if not self.enabled:
+            return
+        data = (fig if isinstance(fig, str) else fig.to_json()).encode('utf-8')
+        if self.compress:
+            data = zlib.compress(data, 1)
+        # Write to a temporary file and rename, so other workers never read a partial figure
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key, generation))
+        except OSError:
+            logger.exception('Could not write the figure to the cache')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        # Other workers write to the folder too, so its size is checked every max_bytes / 8 written by this one
+        with self._lock:
+            self._written += len(data)
+            check = self.max_bytes is not None and self._written >= self.max_bytes // 8
+            if check:
+                self._written = 0
+        if check:
+            self.evict()
+
+    def _files(self) -> list:
+        """ (path, size, last use) of the cached figures """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.json', '.json.z')):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self) -> int:
+        """ Remove the least recently used figures until the folder is below 90% of max_bytes; Returns the number removed """
+        if not self.enabled or self.max_bytes is None:
+            return 0
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        if total > self.max_bytes:
+            for path, size, _ in sorted(files, key=lambda f: f[2]):
+                if total <= self.max_bytes * 0.9:
+                    break
+                removed += self._remove(path)
+                total -= size
+            logger.info(f'Evicted {removed} figures from the figure cache')
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def prune(self, generations: list) -> int:
+        """ Remove the figures of all the generations not in the list; Returns the number removed """
+        if not self.enabled:
+            return 0
+        keep = {self._generation_name(generation) for generation in generations}
+        removed = sum(self._remove(path) for path, _, _ in self._files()
+                      if os.path.basename(path).split('-')[0] not in keep)
+        if removed:
+            logger.info(f'Removed {removed} figures of old data versions from the figure cache')
+        with self._lock:
+            self.pruned += removed
+        return removed
+
+    def clear(self):
+        """ Remove all the cached figures """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(('.json', '.json.z')):
+                self._remove(os.path.join(self.directory, name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0,
+                    'evictions': self.evictions, 'pruned': self.pruned}
+
+
+def prerender(n_years: int = 3, all_provinces: bool = False, clear: bool = False) -> int:
+    """ Build and cache the figures of the most recent years for every boundary level; Returns the number of figures """
+    import drought_heatmap as dh
+
+    if clear:
+        dh.fig_cache.clear()
+    provinces = list(dh.state.province_centers) if all_provinces else ['country']
+    count = 0
+    for year in sorted(dh.state.years, reverse=True)[:n_years]:
+        for province in provinces:
+            for shape in ('country', 'province', 'county'):
+                dh.fig_cache.put(dh.figure_key(province, year, shape), dh.build_figure(province, year, shape),
+                                 generation=dh.figure_generation(year))
+                count += 1
+    logger.info(f'Pre-rendered {count} figures into {dh.fig_cache.directory}')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-render the map figures into the shared figure cache')
+    parser.add_argument('--years', type=int, default=3, help='number of most recent years to render')
+    parser.add_argument('--all-provinces', action='store_true', help='render every province, not only the country view')
+    parser.add_argument('--clear', action='store_true', help='remove the cached figures before rendering')
+    args = parser.parse_args()
+    print(prerender(args.years, args.all_provinces, args.clear))
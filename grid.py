@@ -0,0 +1,91 @@
+""" Downsampling of the SPEI point grid to what the map can show at a given zoom and viewport """
+import base64
+
+import numpy as np
+import pandas as pd
+
+
+TILE_SIZE = 256  # Width of a mapbox tile in pixels at zoom 0
+VALUE_SCALE = 1000  # Values are sent to the browser as int16 thousandths
+MISSING_VALUE = -32768
+
+
+def degrees_per_pixel(zoom: float) -> float:
+    """ Longitude degrees covered by one screen pixel at the zoom level """
+    return 360 / (TILE_SIZE * 2 ** zoom)
+
+
+def clip_points(df: pd.DataFrame, bounds: tuple, margin: float = 0) -> pd.DataFrame:
+    """ Keep the points inside the (min_x, min_y, max_x, max_y) bounding box, extended by margin degrees """
+    min_x, min_y, max_x, max_y = bounds
+    x = df['x'].to_numpy()
+    y = df['y'].to_numpy()
+    mask = (x >= min_x - margin) & (x <= max_x + margin) & (y >= min_y - margin) & (y <= max_y + margin)
+    return df[mask]
+
+
+def aggregate_points(df: pd.DataFrame, cell_size: float) -> pd.DataFrame:
+    """ Average the points falling in the same square cell of cell_size degrees.
+    Cells are anchored at 0,0, so the same points give the same cells in the same order whatever their values, and a
+    point with a missing (NaN) value keeps its cell; The value of a cell is the mean of its known values, NaN if none.
+    Each cell is placed at the mean position of its points, so cells holding a single point don't move.
+    """
+    if df.empty or cell_size <= 0:
+        return df
+    x = df['x'].to_numpy()
+    y = df['y'].to_numpy()
+    value = df['value'].to_numpy()
+    col = np.floor(x / cell_size).astype(np.int64)
+    row = np.floor(y / cell_size).astype(np.int64)
+    # Offsets only number the cells, their edges stay on the multiples of cell_size
+    col -= col.min()
+    row -= row.min()
+    cells, index = np.unique(row * (col.max() + 1) + col, return_inverse=True)
+    index = index.ravel()
+    counts = np.bincount(index, minlength=len(cells))
+    known = ~np.isnan(value)
+    value_counts = np.bincount(index[known], minlength=len(cells))
+    value_sums = np.bincount(index[known], weights=value[known], minlength=len(cells))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = value_sums / value_counts
+    aggregated = pd.DataFrame({
+        'x': (np.bincount(index, weights=x, minlength=len(cells)) / counts).astype(x.dtype),
+        'y': (np.bincount(index, weights=y, minlength=len(cells)) / counts).astype(y.dtype),
+        'value': values.astype(value.dtype),
+    })
+    for column in df.columns.difference(['x', 'y', 'value']):
+        aggregated[column] = df[column].iloc[0]
+    return aggregated[df.columns]
+
+
+def downsample_for_view(df: pd.DataFrame, zoom: float, bounds: tuple = None, margin: float = 0,
+                        pixels_per_cell: float = 2) -> pd.DataFrame:
+    """ Clip the points to the viewport bounds (if given) and merge the points closer than pixels_per_cell pixels """
+    if bounds is not None:
+        df = clip_points(df, bounds, margin)
+    return aggregate_points(df, pixels_per_cell * degrees_per_pixel(zoom))
+
+
+def shape_bounds(geojson: dict) -> dict:
+    """ Bounding box (min_x, min_y, max_x, max_y) of each feature of a GeoJSON FeatureCollection, keyed by feature id """
+    bounds = {}
+    for feature in geojson['features']:
+        coords = np.array(list(_iter_coords(feature['geometry']['coordinates'])))
+        bounds[feature.get('id')] = tuple(float(v) for v in (*coords.min(axis=0), *coords.max(axis=0)))
+    return bounds
+
+
+def _iter_coords(coords):
+    if isinstance(coords[0], (int, float)):
+        yield coords[:2]
+    else:
+        for item in coords:
+            yield from _iter_coords(item)
+
+
+def encode_values(values: np.ndarray) -> dict:
+    """ Compact encoding of the point values for the browser: base64 of little-endian int16 thousandths, NaN as MISSING_VALUE """
+    scaled = np.round(np.clip(values, -32.767, 32.767) * VALUE_SCALE)
+    scaled[np.isnan(scaled)] = MISSING_VALUE
+    return {'scale': VALUE_SCALE, 'missing': MISSING_VALUE,
+            'data': base64.b64encode(scaled.astype('<i2').tobytes()).decode('ascii')}
@@ -0,0 +1,140 @@
+""" Local columnar store of the SPEI series: the grid coordinates are stored once as a point index, and the values as a
+dense (year x point) matrix memory-mapped from disk, so a year is a zero-copy row and a point's history a column.
+Every build is a new folder published with versioned_dir, so the workers' memory maps never see a half written store.
+
+Build or update it from dbo.spei with:
+    python grid_store.py build
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+import data_collection as dc
+import versioned_dir
+from queries import fetch_arrays
+
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = dc.config.get('store', 'Path', fallback=os.path.join(dc.DATA_DIR, 'spei_store'))
+STORE_DTYPE = dc.config.get('store', 'Dtype', fallback='float32')
+
+
+class GridStore:
+    """ Read only view of a store version folder: points.npy (2 x points: x and y), years.npy and values.npy (years x points) """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+        self.years = np.load(os.path.join(path, 'years.npy')).tolist()
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self._year_index = {year: i for i, year in enumerate(self.years)}
+
+    def __contains__(self, year) -> bool:
+        return year in self._year_index
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.points[0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.points[1]
+
+    def year_values(self, year: int) -> np.ndarray:
+        """ Values of all the points in the year (NaN where a point has no value), a view of the memory map """
+        return self.values[self._year_index[year]]
+
+    def year_arrays(self, year: int) -> tuple:
+        """ (x, y, value) float32 arrays of the points that have a value in the year, like the rows of dbo.spei """
+        values = self.year_values(year)
+        missing = np.isnan(values)
+        if missing.any():
+            keep = ~missing
+            return self.x[keep], self.y[keep], values[keep].astype(np.float32)
+        return self.x, self.y, values.astype(np.float32, copy=False)
+
+    def point_history(self, point: int) -> np.ndarray:
+        """ Values of a point in every year of self.years """
+        return self.values[:, point]
+
+    def nearest_point(self, x: float, y: float) -> int:
+        """ Index of the grid point closest to (x, y) """
+        return int(np.argmin((self.x - x) ** 2 + (self.y - y) ** 2))
+
+    def region_series(self, points) -> np.ndarray:
+        """ (years x points) values of a set of points, given as indices or a boolean mask """
+        return self.values[:, points]
+
+
+def build_matrix(x: np.ndarray, y: np.ndarray, year: np.ndarray, value: np.ndarray, dtype: str = STORE_DTYPE):
+    """ Index the unique (x, y) points and pivot the rows into a (year x point) matrix; Returns (points, years, values) """
+    points, point_ids = np.unique(np.stack([x, y], axis=1), axis=0, return_inverse=True)
+    years, year_ids = np.unique(year, return_inverse=True)
+    values = np.full((len(years), len(points)), np.nan, dtype=dtype)
+    values[year_ids.ravel(), point_ids.ravel()] = value
+    return np.ascontiguousarray(points.T), years, values
+
+
+def save_store(points: np.ndarray, years: np.ndarray, values: np.ndarray, path: str = STORE_DIR) -> str:
+    """ Write the store to a new version folder and make it the current one; Returns the folder """
+    folder = versioned_dir.new_version(path, 'store')
+    np.save(os.path.join(folder, 'points.npy'), points)
+    np.save(os.path.join(folder, 'years.npy'), years)
+    np.save(os.path.join(folder, 'values.npy'), values)
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump({'points': int(points.shape[1]), 'years': [int(year) for year in years], 'dtype': str(values.dtype)}, f)
+    # Readers keep their memory maps of the pruned versions open, so removing them is safe on Linux
+    folder = versioned_dir.publish(path, folder)
+    logger.info(f'SPEI store written to {folder}: {len(years)} years x {points.shape[1]} points')
+    return folder
+
+
+def build_store(path: str = STORE_DIR) -> GridStore:
+    """ Build the store from all the rows of dbo.spei """
+    with versioned_dir.build_lock(path):
+        return _build_store(path)
+
+
+def _build_store(path: str) -> GridStore:
+    columns = fetch_arrays(dc.DATA_POOL, 'spei_all', dc.SPEI_DTYPES)
+    return GridStore(save_store(*build_matrix(columns['x'], columns['y'], columns['year'], columns['value']), path))
+
+
+def update_store(years: list, path: str = STORE_DIR) -> GridStore:
+    """ Reload only the given years from dbo.spei into the store (adding new years and points, dropping deleted years).
+    The whole matrix is rewritten, so one process updates it (the polling one of the background refresh) while the
+    build lock keeps a manual build from running at the same time; the other workers reopen the store.
+    """
+    with versioned_dir.build_lock(path):
+        old = open_store(path)
+        if old is None:
+            return _build_store(path)
+        keep = [year for year in old.years if year not in set(years)]
+        kept = old.values[[old.years.index(year) for year in keep]]
+        new = dc.fetch_years(years) if years else {name: np.empty(0, dtype=dtype) for name, dtype in dc.SPEI_DTYPES.items()}
+        n_points = old.points.shape[1]
+        return GridStore(save_store(*build_matrix(
+            np.concatenate([np.tile(old.x, len(keep)), new['x']]),
+            np.concatenate([np.tile(old.y, len(keep)), new['y']]),
+            np.concatenate([np.repeat(np.array(keep, dtype=dc.SPEI_DTYPES['year']), n_points), new['year']]),
+            np.concatenate([kept.ravel(), new['value']]),
+            dtype=str(old.values.dtype),
+        ), path))
+
+
+def open_store(path: str = STORE_DIR):
+    """ The current version of the store at path, or None if it was not built """
+    return versioned_dir.read_current(path, GridStore)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the local SPEI grid store from dbo.spei')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--path', default=STORE_DIR)
+    args = parser.parse_args()
+    store = build_store(args.path)
+    print(f'{len(store.years)} years x {store.points.shape[1]} points')
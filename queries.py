@@ -0,0 +1,154 @@
+""" Parameterized queries of the loaders, run on cached cursors with per-query timing.
+
+Values are always passed as bound parameters (?), so SQL Server reuses one plan per query and can seek on the indexes.
+Each query only selects the columns its callers use.
+"""
+import functools
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip by fetch_arrays
+FETCH_ARRAYSIZE = 65536
+
+QUERIES = {
+    'spei_year': 'SELECT x, y, value FROM dbo.spei WHERE year = ?',
+    'spei_all': 'SELECT x, y, year, value FROM dbo.spei',
+    'years': 'SELECT DISTINCT year FROM dbo.spei',
+    'counties': 'SELECT province_name, county_name FROM dbo.County',
+    'centers': '''SELECT
+                    c.province_name,
+                    c.county_name,
+                    c.longitude as county_lon,
+                    c.latitude as county_lat,
+                    p.longitude as province_lon,
+                    p.latitude as province_lat
+                FROM
+                    dbo.County c LEFT JOIN dbo.Province p ON c.province_id = p.id''',
+    'province_area_stats': 'SELECT province, year, category, area FROM dbo.drought_area_per_province WHERE year >= ?',
+    'province_percentage_stats': 'SELECT province, year, category, percentage FROM dbo.drought_percentage_per_province WHERE year >= ?',
+    'county_area_stats': 'SELECT county, year, category, area FROM dbo.drought_area_per_county WHERE year >= ?',
+    'county_percentage_stats': 'SELECT province, county, year, category, percentage FROM dbo.drought_percentage_per_county WHERE year >= ?',
+}
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def execute(pool, name: str, params: tuple = (), sql: str = None, executor=None):
+    """ Run a named query with bound parameters; Returns (column names, rows).
+    The cursor of the query is cached on its connection, so the prepared statement is reused on the next call.
+    sql overrides the text of QUERIES[name], for queries built from fixed table names.
+    executor (QueryExecutor): Run the query on the executor with its timeout, sharing the result of an identical query
+        already in flight, instead of in the calling thread.
+    """
+    sql = sql or QUERIES[name]
+    return _run(executor, ('execute', pool.name, sql, tuple(params)), name, _execute, pool, name, params, sql)
+
+
+def _execute(pool, name: str, params: tuple, sql: str, timeout: float = None):
+    start = time.perf_counter()
+    with pool.connection() as conn, query_timeout(conn, timeout):
+        cursor = pool.cached_cursor(conn, sql)
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    record_timing(name, time.perf_counter() - start, len(rows))
+    return columns, rows
+
+
+def run_query(pool, name: str, params: tuple = (), sql: str = None, executor=None) -> pd.DataFrame:
+    """ Run a named query with bound parameters and return the result as a DataFrame """
+    columns, rows = execute(pool, name, params, sql, executor)
+    return pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns, coerce_float=True)
+
+
+def fetch_arrays(pool, name: str, dtypes: dict, params: tuple = (), sql: str = None,
+                 expected_rows: int = None, arraysize: int = FETCH_ARRAYSIZE, executor=None) -> dict:
+    """ Run a named query and stream the result in batches of arraysize rows straight into typed NumPy columns,
+    without building a DataFrame of Python objects first; Returns {column: array}.
+    The gain is memory (less than half of a DataFrame) more than speed: the driver still builds a Python row per
+    result row, which takes most of the time, so it is only about 1.2x faster than pd.read_sql_query.
+    expected_rows (int): Size of the preallocated columns, grown by doubling if the result is larger.
+    executor (QueryExecutor): Same as execute; Callers sharing a result get the same arrays, so they must not modify them.
+    """
+    sql = sql or QUERIES[name]
+    key = ('fetch_arrays', pool.name, sql, tuple(params), tuple(dtypes.items()))
+    return _run(executor, key, name, _fetch_arrays, pool, name, dtypes, params, sql, expected_rows, arraysize)
+
+
+def _fetch_arrays(pool, name: str, dtypes: dict, params: tuple, sql: str, expected_rows: int, arraysize: int,
+                  timeout: float = None) -> dict:
+    start = time.perf_counter()
+    with pool.connection() as conn, query_timeout(conn, timeout):
+        cursor = pool.cached_cursor(conn, sql)
+        cursor.arraysize = arraysize
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        capacity = expected_rows or arraysize
+        arrays = {column: np.empty(capacity, dtype=dtypes[column]) for column in columns}
+        n_rows = 0
+        while True:
+            batch = cursor.fetchmany(arraysize)
+            if not batch:
+                break
+            end = n_rows + len(batch)
+            if end > capacity:
+                capacity = max(end, 2 * capacity)
+                arrays = {column: np.resize(array, capacity) for column, array in arrays.items()}
+            # One fromiter per column over the rows of the batch is faster than np.array(batch) or zip(*batch)
+            for i, column in enumerate(columns):
+                arrays[column][n_rows:end] = np.fromiter((row[i] for row in batch), dtype=dtypes[column], count=len(batch))
+            n_rows = end
+    record_timing(name, time.perf_counter() - start, n_rows)
+    return {column: array if n_rows == capacity else array[:n_rows].copy() for column, array in arrays.items()}
+
+
+def _run(executor, key: tuple, name: str, func, *args):
+    """ Call func(*args, timeout=...) in this thread or on the executor, timing the wait as a stage of the request """
+    start = time.perf_counter()
+    try:
+        if executor is None:
+            return func(*args, timeout=None)
+        return executor.run(key, functools.partial(func, timeout=executor.timeout), *args)
+    finally:
+        tracing.add_stage(f'query:{name}', time.perf_counter() - start)
+
+
+@contextmanager
+def query_timeout(conn, seconds: float = None):
+    """ Let the server cancel the queries of the block after the timeout, on drivers supporting it (pyodbc) """
+    if not seconds or not hasattr(conn, 'timeout'):
+        yield
+        return
+    conn.timeout = int(math.ceil(seconds))
+    try:
+        yield
+    finally:
+        conn.timeout = 0
+
+
+def record_timing(name: str, seconds: float, rows: int):
+    logger.debug(f'Query {name}: {rows} rows in {seconds * 1000:.1f} ms')
+    with _stats_lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'rows': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['rows'] += rows
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def query_stats() -> dict:
+    """ Calls, rows, total and max time of each query since the worker started """
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
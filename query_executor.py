@@ -0,0 +1,129 @@
+""" Bounded executor running the database queries of the request threads, with a timeout per call, coalescing of
+identical in-flight queries and cancellation of the queries of superseded requests.
+
+Run gunicorn with threaded workers (gthread) so a worker keeps serving other requests while some wait for the database:
+the executor bounds the number of concurrent queries per worker, and a burst of requests for the same year waits on a
+single query.
+"""
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryTimeout(Exception):
+    """ Raised when a query did not finish in time """
+
+
+class Superseded(Exception):
+    """ Raised in a request waiting for a query when a newer request of the same channel arrived """
+
+
+class QueryExecutor:
+    """ Thread pool running the queries, shared by all the request threads of a worker.
+
+    max_workers (int): Maximum number of queries running at once; Other calls wait in the queue.
+    timeout (float): Seconds a call waits for its result before raising QueryTimeout.
+    """
+
+    def __init__(self, max_workers: int = 5, timeout: float = 30, name: str = 'query'):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.name = name
+        # Reentrant: cancelling a future runs its done callback, which takes the lock again
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._reset()
+
+    def _reset(self):
+        """ Start without threads or in-flight calls, at creation and after a fork (gunicorn workers) """
+        self._pid = os.getpid()
+        self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name)
+        self._inflight = {}  # key -> [future, number of waiting calls]
+        self._channels = {}  # channel -> Future set when a newer call of the channel arrives
+        self.metrics = {'calls': 0, 'executed': 0, 'coalesced': 0, 'timeouts': 0, 'superseded': 0, 'cancelled': 0}
+
+    @contextmanager
+    def channel(self, key):
+        """ Calls made in the with block belong to the channel (e.g. (page id, callback name)); A newer block of the
+        same channel makes the older one's waiting call raise Superseded
+        """
+        with self._lock:
+            previous = self._channels.get(key)
+            if previous is not None:
+                previous.set_result(True)
+            superseded = self._channels[key] = Future()
+        self._local.superseded = superseded
+        try:
+            yield
+        finally:
+            self._local.superseded = None
+            with self._lock:
+                if self._channels.get(key) is superseded:
+                    del self._channels[key]
+
+    def run(self, key, func, *args, timeout: float = None):
+        """ Run func(*args) in the pool and return its result; Calls with the same key while it runs share its result.
+        func runs in a copy of the caller's context, so the stages it records are part of the caller's request trace.
+        """
+        superseded = getattr(self._local, 'superseded', None)
+        if superseded is not None and superseded.done():
+            with self._lock:
+                self.metrics['superseded'] += 1
+            raise Superseded()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self.metrics['calls'] += 1
+            entry = self._inflight.get(key)
+            if entry is None:
+                entry = self._inflight[key] = [self._pool.submit(contextvars.copy_context().run, func, *args), 0]
+                entry[0].add_done_callback(lambda _, key=key, entry=entry: self._finished(key, entry))
+                self.metrics['executed'] += 1
+            else:
+                self.metrics['coalesced'] += 1
+            entry[1] += 1
+        future = entry[0]
+        try:
+            done, _ = wait([future] + ([superseded] if superseded is not None else []),
+                           timeout=self.timeout if timeout is None else timeout, return_when=FIRST_COMPLETED)
+            if future in done:
+                return future.result()
+            if superseded is not None and superseded in done:
+                with self._lock:
+                    self.metrics['superseded'] += 1
+                raise Superseded()
+            with self._lock:
+                self.metrics['timeouts'] += 1
+            raise QueryTimeout(f'{key} did not finish in {self.timeout if timeout is None else timeout} s')
+        finally:
+            self._release(key, entry)
+
+    def _release(self, key, entry):
+        """ Forget a waiting call, and cancel the query if nobody waits for it and it did not start yet """
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done() and entry[0].cancel():
+                self.metrics['cancelled'] += 1
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+
+    def _finished(self, key, entry):
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['inflight'] = len(self._inflight)
+            return stats
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
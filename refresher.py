@@ -0,0 +1,192 @@
+""" Background polling of cheap change markers of the source tables, reloading only what changed.
+
+Each watch runs a query returning one row per year (year first) or a few aggregate rows. Only one process, the leader
+holding the lock file, queries the databases: when a watch's result differs from the published one it runs the
+watch's publisher (rebuilding the local files shared by the workers) and then publishes the new markers to the state
+file. Every process, the leader included, reads the state file and calls the handler of each changed watch with the
+old and new markers, in the refresher thread, so request threads never wait for a reload; handlers swap the reloaded
+data into the live caches with single assignments. Without fcntl (Windows) every process is a leader.
+"""
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def changed_years(old: dict, new: dict) -> list:
+    """ Years whose marker is new, different or removed between two per-year markers """
+    return sorted(year for year in set(old) | set(new) if old.get(year) != new.get(year))
+
+
+def removed_years(old: dict, new: dict) -> list:
+    """ Years of the old markers that are no longer in the new ones (deleted from the source) """
+    return sorted(set(old) - set(new))
+
+
+class Watch:
+    """ A change marker query on a connection pool and the handler to call when its result changes.
+
+    per_year (bool): The query returns (year, marker...) rows, and markers are compared as {year: (marker...)}.
+    publisher (callable): Called as publisher(old, new) by the leader only, before the new markers are published.
+    """
+
+    def __init__(self, name: str, pool, queries, handler, per_year: bool = False, publisher=None):
+        self.name = name
+        self.pool = pool
+        self.queries = [queries] if isinstance(queries, str) else list(queries)
+        self.handler = handler
+        self.per_year = per_year
+        self.publisher = publisher
+
+    def read(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            rows = []
+            for query in self.queries:
+                cursor.execute(query)
+                rows.extend(tuple(row) for row in cursor.fetchall())
+            cursor.close()
+        return self.decode(json.loads(json.dumps(self.encode(rows, raw=True), default=str)))
+
+    def encode(self, markers, raw: bool = False) -> list:
+        """ JSON compatible form of the markers (or of the raw rows of the queries) """
+        if raw or not self.per_year:
+            return [list(row) for row in markers]
+        return [[year, *marker] for year, marker in markers.items()]
+
+    def decode(self, rows: list):
+        if not self.per_year:
+            return [tuple(row) for row in rows]
+        markers = {}
+        for row in rows:
+            markers[int(row[0])] = markers.get(int(row[0]), ()) + tuple(row[1:])
+        return markers
+
+
+class Refresher(threading.Thread):
+    """ Daemon thread polling the watches every interval seconds.
+
+    state_path (str): JSON file the leader publishes the markers to, read by all the processes; None keeps them in memory.
+    lock_path (str): File locked by the leader; None makes every process a leader.
+    """
+
+    def __init__(self, watches: list, interval: float = 300, state_path: str = None, lock_path: str = None):
+        super().__init__(name='refresher', daemon=True)
+        self.watches = watches
+        self.interval = interval
+        self.state_path = state_path
+        self.lock_path = lock_path
+        self.markers = {}  # Markers of the data loaded by this process
+        self._published = {}
+        self._lock_file = None
+        self._stop_event = threading.Event()
+
+    def is_leader(self) -> bool:
+        """ Whether this process polls the databases; Takes the lock when it is free (e.g. the previous leader exited) """
+        if self._lock_file is not None or fcntl is None or self.lock_path is None:
+            return True
+        f = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f
+        logger.info(f'Process {os.getpid()} polls the change markers of the source tables')
+        return True
+
+    def read_state(self) -> dict:
+        """ The published markers of each watch """
+        if self.state_path is None:
+            return dict(self._published)
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return {watch.name: watch.decode(state[watch.name]) for watch in self.watches if watch.name in state}
+
+    def write_state(self, markers: dict):
+        if self.state_path is None:
+            self._published = dict(markers)
+            return
+        state = {watch.name: watch.encode(markers[watch.name]) for watch in self.watches if watch.name in markers}
+        tmp_path = f'{self.state_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def baseline(self):
+        """ Take the published markers as the ones of the data this process is about to load; Call before loading it """
+        self.markers = self.read_state()
+
+    def check_sources(self):
+        """ Read the markers from the databases, run the publishers of the changed watches and publish the new markers;
+        The first read of a watch is the baseline
+        """
+        published = self.read_state()
+        changed = False
+        for watch in self.watches:
+            try:
+                new = watch.read()
+            except Exception:
+                logger.warning(f'Could not read the change markers of {watch.name}', exc_info=True)
+                continue
+            old = published.get(watch.name)
+            if new == old:
+                continue
+            if old is not None and watch.publisher is not None:
+                logger.info(f'Change detected in {watch.name}, rebuilding the shared data')
+                try:
+                    watch.publisher(old, new)
+                except Exception:
+                    logger.exception(f'Rebuilding {watch.name} failed, retrying on the next poll')
+                    continue
+            published[watch.name] = new
+            changed = True
+        if changed:
+            self.write_state(published)
+
+    def apply(self):
+        """ Call the handlers of the watches whose published markers differ from the ones of this process """
+        published = self.read_state()
+        for watch in self.watches:
+            new = published.get(watch.name)
+            if new is None:
+                continue
+            if watch.name not in self.markers:
+                self.markers[watch.name] = new
+                continue
+            old = self.markers[watch.name]
+            if new == old:
+                continue
+            logger.info(f'Change detected in {watch.name}, refreshing')
+            try:
+                watch.handler(old, new)
+            except Exception:
+                logger.exception(f'Refreshing {watch.name} failed, retrying on the next poll')
+                continue
+            self.markers[watch.name] = new
+
+    def poll(self):
+        if self.is_leader():
+            self.check_sources()
+        self.apply()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Polling the change markers failed')
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,157 @@
+""" Spatial index of the SPEI grid: every point is assigned to its province and county polygon once, so any year's values
+can be aggregated per region, or over a polygon drawn on the map, with array indexing instead of polygon scans.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point, Polygon, shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+# SPEI classes, from the driest; A value belongs to the first class whose upper edge is >= the value
+CATEGORIES = ['Extremly dry', 'Sever dry', 'Moderate dry', 'Slight dry',
+              'Normal', 'Slight wet', 'Moderate wet', 'Sever wet', 'Extremly wet']
+CATEGORY_EDGES = np.array([-2, -1.5, -1, -0.5, 0.5, 1, 1.5, 2], dtype=np.float32)
+
+OUTSIDE = -1  # Region code of the points outside all the shapes
+
+
+def classify(values: np.ndarray) -> np.ndarray:
+    """ Category index (position in CATEGORIES) of each value; NaN values get -1 """
+    codes = np.digitize(values, CATEGORY_EDGES, right=True).astype(np.int8)
+    codes[np.isnan(values)] = -1
+    return codes
+
+
+def point_keys(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ One uint64 key per point from the bits of its float32 coordinates, to match the points of different arrays """
+    x = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    y = np.ascontiguousarray(y, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    return (x << np.uint64(32)) | y
+
+
+def assign_points(x: np.ndarray, y: np.ndarray, geometries: list) -> np.ndarray:
+    """ Index of the geometry containing each point (the first one when shapes overlap), OUTSIDE if none does """
+    codes = np.full(len(x), OUTSIDE, dtype=np.int32)
+    if not len(geometries) or not len(x):
+        return codes
+    tree = STRtree(geometries)
+    if hasattr(shapely, 'points'):
+        point_ids, geometry_ids = tree.query(shapely.points(x, y), predicate='intersects')
+        # Reversed, so the first geometry of a point is written last
+        codes[point_ids[::-1]] = geometry_ids[::-1]
+    else:
+        """ Shapely < 2 has no vectorized predicates, test the candidates of each shape's bounding box instead """
+        for i, geometry in reversed(list(enumerate(geometries))):
+            min_x, min_y, max_x, max_y = geometry.bounds
+            candidates = np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+            prepared = prep(geometry)
+            inside = [j for j in candidates if prepared.intersects(Point(x[j], y[j]))]
+            codes[inside] = i
+    return codes
+
+
+def points_in(x: np.ndarray, y: np.ndarray, geometry) -> np.ndarray:
+    """ Indices of the points inside a geometry """
+    min_x, min_y, max_x, max_y = geometry.bounds
+    candidates = np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+    if hasattr(shapely, 'contains_xy'):
+        return candidates[shapely.contains_xy(geometry, x[candidates], y[candidates])]
+    prepared = prep(geometry)
+    return candidates[[prepared.contains(Point(x[j], y[j])) for j in candidates]]
+
+
+def selection_geometry(selected_data: dict):
+    """ Polygon of a box or lasso selection of a mapbox figure (selectedData of dcc.Graph), or None """
+    if not selected_data:
+        return None
+    if selected_data.get('lassoPoints', {}).get('mapbox'):
+        return Polygon(selected_data['lassoPoints']['mapbox'])
+    if selected_data.get('range', {}).get('mapbox'):
+        (x0, y0), (x1, y1) = selected_data['range']['mapbox']
+        return Polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+    return None
+
+
+class RegionIndex:
+    """ Region of every point of a fixed grid for each boundary level.
+
+    x, y (np.ndarray): Coordinates of the grid points, e.g. the point index of the SPEI store.
+    shapes (dict): GeoJSON FeatureCollection of each level, with the region names as feature ids.
+    """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, shapes: dict, levels: tuple = ('province', 'county')):
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.names = {}
+        self.codes = {}
+        for level in levels:
+            features = shapes[level]['features']
+            self.names[level] = [feature.get('id') for feature in features]
+            self.codes[level] = assign_points(self.x, self.y, [shape(feature['geometry']) for feature in features])
+        keys = point_keys(self.x, self.y)
+        self._order = np.argsort(keys)
+        self._sorted_keys = keys[self._order]
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def point_ids(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """ Position in the index of each (x, y) point, -1 for points that are not in the grid """
+        keys = point_keys(x, y)
+        if not len(self._sorted_keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        found = np.searchsorted(self._sorted_keys, keys).clip(max=len(self._sorted_keys) - 1)
+        ids = self._order[found]
+        ids[self._sorted_keys[found] != keys] = -1
+        return ids
+
+    def align(self, x: np.ndarray, y: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """ Values of the given points in the order of the index points, NaN for the index points without a value """
+        ids = self.point_ids(x, y)
+        found = ids >= 0
+        aligned = np.full(len(self.x), np.nan, dtype=np.float32)
+        aligned[ids[found]] = np.asarray(values)[found]
+        return aligned
+
+    def region_codes(self, level: str, x: np.ndarray = None, y: np.ndarray = None) -> np.ndarray:
+        """ Region code of each point of the index, or of the given points (OUTSIDE for unknown points) """
+        codes = self.codes[level]
+        if x is None:
+            return codes
+        ids = self.point_ids(x, y)
+        return np.where(ids >= 0, codes[ids], OUTSIDE)
+
+    def region_points(self, level: str, name: str) -> np.ndarray:
+        """ Indices of the points of a region """
+        return np.flatnonzero(self.codes[level] == self.names[level].index(name))
+
+    def summary(self, level: str, values: np.ndarray, x: np.ndarray = None, y: np.ndarray = None) -> pd.DataFrame:
+        """ Number of points, mean value and share of each category (percentage of the points with a value) per region.
+        values are in the order of the index points, or of the given x and y.
+        """
+        names = self.names[level]
+        codes = self.region_codes(level, x, y)
+        values = np.asarray(values)
+        valid = (codes != OUTSIDE) & ~np.isnan(values)
+        codes, values = codes[valid], values[valid]
+        counts = np.bincount(codes, minlength=len(names))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(codes, weights=values, minlength=len(names)) / counts
+            histogram = np.bincount(codes * len(CATEGORIES) + classify(values),
+                                    minlength=len(names) * len(CATEGORIES)).reshape(len(names), len(CATEGORIES))
+            percentage = 100 * histogram / counts[:, None]
+        df = pd.DataFrame(percentage, columns=CATEGORIES)
+        df.insert(0, level, names)
+        df.insert(1, 'points', counts)
+        df.insert(2, 'mean', mean)
+        return df
+
+    def selection_summary(self, geometry, values: np.ndarray) -> pd.DataFrame:
+        """ Share of each category (percentage) of the index points inside a geometry, values in the order of the index """
+        selected = values[points_in(self.x, self.y, geometry)]
+        selected = selected[~np.isnan(selected)]
+        counts = np.bincount(classify(selected), minlength=len(CATEGORIES))
+        percentage = 100 * counts / len(selected) if len(selected) else np.zeros(len(CATEGORIES))
+        return pd.DataFrame({'category': CATEGORIES, 'points': counts, 'percentage': percentage})
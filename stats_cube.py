@@ -0,0 +1,167 @@
+""" In-memory cube of the drought statistics indexed by (level, region, year, category).
+
+The bar and pie charts read slices of the cube instead of querying the database on every interaction.
+"""
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+import data_collection as dc
+
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ('country', 'province', 'county')
+COUNTRY = 'country'
+
+
+def _merge_labels(labels: list, new_labels) -> list:
+    """ Append the new labels that are not already in the list, keeping the existing positions """
+    known = set(labels)
+    return labels + [x for x in pd.unique(pd.Series(new_labels)) if x not in known]
+
+
+def _grow(array: np.ndarray, shape: tuple) -> np.ndarray:
+    """ Copy the array into a larger one filled with NaN """
+    grown = np.full(shape, np.nan)
+    grown[tuple(slice(0, n) for n in array.shape)] = array
+    return grown
+
+
+class StatsCube:
+    """ Area and percentage of each drought category per region and year for the country, province and county levels.
+    Updates build a new state and swap it in a single assignment, so readers never see a half updated cube.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {
+            'regions': {level: [] for level in LEVELS},
+            'parents': {},
+            'years': [],
+            'categories': [],
+            'area': {level: np.full((0, 0, 0), np.nan) for level in LEVELS},
+            'percentage': {level: np.full((0, 0, 0), np.nan) for level in LEVELS},
+        }
+
+    @property
+    def years(self) -> list:
+        return list(self._state['years'])
+
+    def update(self, tables: dict):
+        """ Add the statistics tables (output of data_collection.load_region_statistics); Each table replaces all the
+        cells of the years it has rows for
+        """
+        with self._lock:
+            old = self._state
+            regions = {
+                COUNTRY: [COUNTRY],
+                'province': _merge_labels(old['regions']['province'], pd.concat([tables['province_area']['province'], tables['province_percentage']['province']])),
+                'county': _merge_labels(old['regions']['county'], pd.concat([tables['county_area']['county'], tables['county_percentage']['county']])),
+            }
+            years = sorted(set(old['years']).union(*(df['year'] for df in tables.values())))
+            categories = _merge_labels(old['categories'], pd.concat([df['category'] for df in tables.values()]))
+            year_index = {year: i for i, year in enumerate(years)}
+
+            state = {'regions': regions, 'years': years, 'categories': categories, 'area': {}, 'percentage': {}}
+            state['parents'] = dict(old['parents'])
+            state['parents'].update(tables['county_percentage'].drop_duplicates('county').set_index('county')['province'].to_dict())
+
+            for kind in ('area', 'percentage'):
+                for level in ('province', 'county'):
+                    shape = (len(regions[level]), len(years), len(categories))
+                    array = np.full(shape, np.nan)
+                    # Years are sorted, so existing years may move when an older year is added
+                    old_array = old[kind][level]
+                    if old_array.size:
+                        old_years = [year_index[year] for year in old['years']]
+                        array[:old_array.shape[0], old_years, :old_array.shape[2]] = old_array
+                    df = tables[f'{level}_{kind}']
+                    # The table replaces all the cells of its years, so rows removed from the source do not stay behind
+                    array[:, [year_index[year] for year in pd.unique(df['year'])], :] = np.nan
+                    rows = pd.Categorical(df[level], categories=regions[level]).codes
+                    cols = df['year'].map(year_index).to_numpy()
+                    cats = pd.Categorical(df['category'], categories=categories).codes
+                    array[rows, cols, cats] = df[kind].to_numpy(dtype=np.float64)
+                    state[kind][level] = array
+
+            """ Country aggregates: total area of the provinces, and its share of the total area of each year """
+            country_area = np.nansum(state['area']['province'], axis=0, keepdims=True)
+            missing = np.isnan(state['area']['province']).all(axis=0, keepdims=True)
+            country_area[missing] = np.nan
+            total = np.nansum(country_area, axis=2, keepdims=True)
+            state['area'][COUNTRY] = country_area
+            with np.errstate(invalid='ignore', divide='ignore'):
+                state['percentage'][COUNTRY] = np.where(total > 0, country_area / total * 100, np.nan)
+            self._state = state
+        logger.info(f'Statistics cube updated: {len(years)} years, {len(regions["province"])} provinces, {len(regions["county"])} counties')
+
+    def remove_years(self, years: list):
+        """ Drop the years deleted from the statistics tables """
+        removed = set(years)
+        with self._lock:
+            old = self._state
+            keep = [i for i, year in enumerate(old['years']) if year not in removed]
+            if len(keep) == len(old['years']):
+                return
+            state = dict(old, years=[old['years'][i] for i in keep])
+            for kind in ('area', 'percentage'):
+                state[kind] = {level: array[:, keep, :] for level, array in old[kind].items()}
+            self._state = state
+        logger.info(f'Statistics cube: removed years {sorted(removed)}')
+
+    def _frame(self, state, kind: str, level: str, regions: list, years: list, region_column: str) -> pd.DataFrame:
+        """ Long format DataFrame of the cube slice, skipping the missing cells """
+        region_index = {name: i for i, name in enumerate(state['regions'][level])}
+        year_index = {year: i for i, year in enumerate(state['years'])}
+        regions = [r for r in regions if r in region_index]
+        years = [y for y in years if y in year_index]
+        values = state[kind][level][np.ix_([region_index[r] for r in regions], [year_index[y] for y in years])]
+        df = pd.DataFrame({
+            region_column: np.repeat(regions, len(years) * len(state['categories'])),
+            'year': np.tile(np.repeat(years, len(state['categories'])), len(regions)),
+            'category': np.tile(state['categories'], len(regions) * len(years)),
+            kind: values.ravel(),
+        })
+        return df.dropna(subset=[kind]).reset_index(drop=True)
+
+    def province_category(self, province: str, last_years: int = 20) -> pd.DataFrame:
+        """ Category percentages of the province (or 'country') in the last years; Columns province, year, category, percentage """
+        state = self._state
+        years = [y for y in state['years'] if y >= max(state['years'], default=0) - last_years]
+        level = COUNTRY if province == COUNTRY else 'province'
+        return self._frame(state, 'percentage', level, [province], years, 'province')
+
+    def region_year(self, year: int, province: str) -> pd.DataFrame:
+        """ Category percentages of the sub regions of the province (or 'country') in the year;
+        Columns province (the sub region), percentage, category, year
+        """
+        state = self._state
+        if province == COUNTRY:
+            level, regions = 'province', state['regions']['province']
+        else:
+            level = 'county'
+            regions = [c for c in state['regions']['county'] if state['parents'].get(c) == province]
+        df = self._frame(state, 'percentage', level, sorted(regions, reverse=True), [year], 'province')
+        return df[['province', 'percentage', 'category', 'year']]
+
+    def region_area(self, year: int, region: str, level: int) -> pd.DataFrame:
+        """ Category areas of a region in the year, level being 0 (country), 1 (province) or 2 (county);
+        Columns country/province/county (the level name), year, category, area
+        """
+        level_name = LEVELS[level]
+        region = COUNTRY if level == 0 else region
+        return self._frame(self._state, 'area', level_name, [region], [year], level_name)
+
+
+def load_cube(cube: StatsCube = None) -> StatsCube:
+    """ Load all the statistics tables into a new cube, or only the years after its last year into an existing one """
+    if cube is None:
+        cube = StatsCube()
+        tables = dc.load_region_statistics()
+    else:
+        tables = dc.load_region_statistics(min_year=max(cube.years, default=None))
+    cube.update(tables)
+    return cube
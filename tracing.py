@@ -0,0 +1,245 @@
+""" Request level latency tracing of the Dash callbacks and the data loaders.
+
+Callbacks decorated with traced_callback() record their total time, and every traced() function, stage() block or
+add_stage() call made while they run (loaders, queries, pool checkouts, figure builds) is a stage of the request.
+The Flask hooks installed by install() add the request time, the response bytes and the Dash overhead (request parsing
+and JSON serialization) of each callback output. Everything is kept as histograms and served as Prometheus text on /metrics.
+"""
+import contextvars
+import cProfile
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+BUCKETS_BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+settings = {'slow_ms': 1000.0, 'profile_dir': None, 'callback_outputs': None}
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of observed values """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {}  # (metric, label) -> Histogram
+_counters = {}  # (metric, label) -> int
+_stats_sources = {}  # name -> function returning a dict of numbers
+_local = threading.local()
+# Stages of the running callback; A context variable, so threads running in a copy of the callback's context
+# (the QueryExecutor threads) add to the same breakdown
+_stages = contextvars.ContextVar('stages', default=None)
+_profile_lock = threading.Lock()
+
+
+def observe(metric: str, label: str, value: float, buckets: tuple = BUCKETS_MS):
+    """ Add a value to the histogram of (metric, label) """
+    with _lock:
+        histogram = _histograms.get((metric, label))
+        if histogram is None:
+            histogram = _histograms[(metric, label)] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def count(metric: str, label: str, n: int = 1):
+    """ Increment the counter of (metric, label), e.g. count('cache', 'figure_hit') """
+    with _lock:
+        _counters[(metric, label)] = _counters.get((metric, label), 0) + n
+
+
+def add_stage(name: str, seconds: float):
+    """ Record a stage timed by the caller; Part of the current request's breakdown if a traced callback is running """
+    observe('stage_ms', name, seconds * 1000)
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds * 1000
+
+
+@contextmanager
+def stage(name: str):
+    """ Time the with block as a stage """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(name, time.perf_counter() - start)
+
+
+def traced(name: str = None):
+    """ Decorator timing every call of a function (a loader) as a stage """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_callback(name: str = None):
+    """ Decorator timing a Dash callback, with the stages recorded while it runs as its breakdown.
+    Callbacks slower than settings['slow_ms'] are logged with their stages, and profiled when a profile_dir is set.
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _run_callback(label, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _run_callback(label: str, func, args: tuple, kwargs: dict):
+    token = _stages.set({})
+    # One profile at a time: cProfile can not run in two threads at once
+    profiler = None
+    if settings['profile_dir'] and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        return func(*args, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # Copied: a query of the callback may still be running on an executor thread after a timeout
+        stages = dict(_stages.get())
+        _stages.reset(token)
+        _local.callback_ms = getattr(_local, 'callback_ms', 0.0) + elapsed_ms
+        observe('callback_ms', label, elapsed_ms)
+        if elapsed_ms > settings['slow_ms']:
+            breakdown = ', '.join(f'{k} {v:.0f} ms' for k, v in sorted(stages.items(), key=lambda item: -item[1]))
+            logger.warning(f'Slow callback {label}: {elapsed_ms:.0f} ms ({breakdown})')
+            count('slow_callbacks', label)
+            if profiler is not None:
+                _dump_profile(profiler, label)
+        if profiler is not None:
+            _profile_lock.release()
+
+
+def _dump_profile(profiler: cProfile.Profile, label: str):
+    path = os.path.join(settings['profile_dir'], f'{label}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.prof')
+    try:
+        os.makedirs(settings['profile_dir'], exist_ok=True)
+        profiler.dump_stats(path)
+        logger.info(f'Profile of the slow callback {label} written to {path}')
+    except OSError:
+        logger.exception('Could not write the profile')
+
+
+def register_stats(name: str, func):
+    """ Serve the numbers of the dict returned by func (e.g. a cache's stats method) as gauges on /metrics """
+    _stats_sources[name] = func
+
+
+def _before_request():
+    flask.g.trace_start = time.perf_counter()
+    _local.callback_ms = 0.0
+
+
+def _after_request(response):
+    start = getattr(flask.g, 'trace_start', None)
+    if start is None or flask.request.path == '/metrics':
+        return response
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    # Labels come from a fixed set (the routes and the registered callback outputs), so clients can not add series
+    rule = flask.request.url_rule
+    label = rule.rule if rule is not None else 'unmatched'
+    if flask.request.path.endswith('/_dash-update-component'):
+        body = flask.request.get_json(silent=True) or {}
+        outputs = settings['callback_outputs']
+        output = body.get('output')
+        if outputs is not None and isinstance(output, str) and output in outputs():
+            label = output
+        observe('overhead_ms', label, max(elapsed_ms - getattr(_local, 'callback_ms', 0.0), 0.0))
+    observe('request_ms', label, elapsed_ms)
+    if response.content_length is not None:
+        observe('response_bytes', label, response.content_length, BUCKETS_BYTES)
+    return response
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def render_metrics() -> str:
+    """ All the histograms, counters and registered stats in the Prometheus text format """
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+    for (metric, label), histogram in histograms:
+        cumulative = 0
+        for bound, n in zip((*histogram.buckets, '+Inf'), histogram.counts):
+            cumulative += n
+            lines.append(f'drought_{metric}_bucket{{name="{_label(label)}",le="{bound}"}} {cumulative}')
+        lines.append(f'drought_{metric}_sum{{name="{_label(label)}"}} {histogram.sum:.3f}')
+        lines.append(f'drought_{metric}_count{{name="{_label(label)}"}} {histogram.count}')
+    for (metric, label), value in counters:
+        lines.append(f'drought_{metric}_total{{name="{_label(label)}"}} {value}')
+    for name, func in sorted(_stats_sources.items()):
+        try:
+            stats = func()
+        except Exception:
+            logger.exception(f'Could not read the stats of {name}')
+            continue
+        for key, value in _flatten(stats):
+            lines.append(f'drought_{name}{{key="{_label(key)}"}} {float(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _flatten(stats: dict, prefix: str = ''):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def install(server: flask.Flask, slow_ms: float = 1000, profile_dir: str = None, allow_remote: bool = False,
+            callback_outputs=None):
+    """ Add the request hooks and the /metrics endpoint to the Flask server.
+    allow_remote (bool): Serve /metrics to other hosts too, instead of the local machine only. Requests forwarded by a
+        reverse proxy (with an X-Forwarded-For header) count as remote, since the proxy connects from the local machine.
+    callback_outputs (callable): Returns the callback outputs used as labels (e.g. lambda: app.callback_map); Other
+        outputs posted to /_dash-update-component are labelled with the route.
+    """
+    settings['slow_ms'] = slow_ms
+    settings['profile_dir'] = profile_dir or None
+    settings['callback_outputs'] = callback_outputs
+    server.before_request(_before_request)
+    server.after_request(_after_request)
+
+    @server.route('/metrics')
+    def metrics():
+        local = flask.request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in flask.request.headers
+        if not allow_remote and not local:
+            flask.abort(403)
+        return flask.Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,130 @@
+""" Versioned folders published through a CURRENT pointer, for the local files shared by the gunicorn workers
+(the reference data snapshot and the SPEI store).
+
+Every build is written to a new hidden folder, renamed to a unique name and made current by atomically replacing the
+CURRENT file, so readers never see a half written folder and concurrent builds never write to the same one.
+Builders hold build_lock, so one process builds while the others wait and then reopen the current folder.
+Publishing prunes the older folders, keeping the previous one for the readers still loading it.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock between processes, fine for the single process development server
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+POINTER = 'CURRENT'
+LOCK_FILE = '.lock'
+PUBLISH_LOCK_FILE = '.publish.lock'
+
+# Published folders kept, the current one included, and age after which an unpublished build folder was left by a crash
+KEEP_VERSIONS = 2
+ABANDONED_SECONDS = 24 * 3600
+
+
+def current(path: str):
+    """ The current folder of path, or None if nothing was published """
+    try:
+        with open(os.path.join(path, POINTER)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(path, name) if name else None
+
+
+def new_version(path: str, prefix: str) -> str:
+    """ Create an empty hidden folder for a new build """
+    os.makedirs(path, exist_ok=True)
+    return tempfile.mkdtemp(dir=path, prefix=f'.{prefix}-')
+
+
+def publish(path: str, folder: str, keep: int = KEEP_VERSIONS) -> str:
+    """ Rename the built folder to its final unique name, make it the current one and prune the older folders;
+    Returns the final folder
+    """
+    name = os.path.basename(folder).lstrip('.')
+    target = os.path.join(path, name)
+    # Short lock of its own (not build_lock, which the builder may hold), so a prune never races a newer publish
+    with _locked(path, PUBLISH_LOCK_FILE):
+        os.rename(folder, target)
+        pointer = os.path.join(path, f'.{POINTER}-{os.getpid()}')
+        with open(pointer, 'w') as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(path, POINTER))
+        prune(path, keep)
+    return target
+
+
+def prune(path: str, keep: int = KEEP_VERSIONS) -> list:
+    """ Remove the published folders except the current one and the most recent others, up to keep folders,
+    and the unpublished build folders older than ABANDONED_SECONDS; Returns the removed folders.
+    Published folders are ordered by their status change time, which the rename of publish sets.
+    """
+    current_folder = current(path)
+    now = time.time()
+    published, removed = [], []
+    for entry in os.scandir(path):
+        if not entry.is_dir(follow_symlinks=False) or entry.path == current_folder:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if not entry.name.startswith('.'):
+            published.append((stat.st_ctime, entry.path))
+        elif now - stat.st_mtime > ABANDONED_SECONDS:
+            removed.append(entry.path)
+    published.sort(reverse=True)
+    removed.extend(folder for _, folder in published[max(keep - 1, 0):])
+    for folder in removed:
+        shutil.rmtree(folder, ignore_errors=True)
+    if removed:
+        logger.info(f'Removed {len(removed)} old versions from {path}')
+    return removed
+
+
+def read_current(path: str, load, retries: int = 3):
+    """ Return load(folder) of the current folder, or None if nothing was published.
+    Retried when the folder is removed while it is read (a newer version was published and the old one pruned).
+    """
+    for attempt in range(retries):
+        folder = current(path)
+        if folder is None:
+            return None
+        try:
+            return load(folder)
+        except FileNotFoundError:
+            if attempt == retries - 1:
+                raise
+            logger.info(f'{folder} was replaced while reading it, reading the current version')
+
+
+def build_lock(path: str):
+    """ Hold the exclusive build lock of path for the with block, waiting for other processes building it """
+    return _locked(path, LOCK_FILE)
+
+
+@contextmanager
+def _locked(path: str, file_name: str):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, file_name), 'a') as f:
+        if fcntl is None:
+            yield
+            return
+        start = time.monotonic()
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        waited = time.monotonic() - start
+        if waited > 1:
+            logger.info(f'Waited {waited:.1f} s for the {file_name} lock of {path}')
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)